@@ -0,0 +1,583 @@
+#!/usr/bin/env python3
+import asyncio
+import httpx
+import io
+import json
+import kopf
+import logging
+import os
+from httpx_auth import AWS4Auth
+from kubernetes_asyncio import config
+from lib import PhaseTimer, Reclaimer, ResourceGraph, Secret, Sweeper, at_shutdown, configure_webhook, decode_secret, ensure_resource, fair, get_class_cache, get_cluster_semaphore, get_shard_ring, is_unchanged, make_fingerprint, make_selector, make_validator, open_api_client, open_event_sink, open_shard_ring, parse_capacity, read_credentials, roll_out, shutdown, spawn, tear_down, thaw
+from minio.crypto import decrypt, encrypt
+from xml.etree import ElementTree
+
+with open(os.path.join(os.path.dirname(__file__), "minio-owner.json")) as fh:
+    OWNER_POLICY = fh.read()
+
+FIELD_MANAGER = "minio-operator"
+
+# HTTP client tunables for talking to MinIO clusters
+MINIO_MAX_CONNECTIONS = int(os.getenv("MINIO_MAX_CONNECTIONS", "16"))
+MINIO_KEEPALIVE_EXPIRY = float(os.getenv("MINIO_KEEPALIVE_EXPIRY", "60"))
+MINIO_TIMEOUT = float(os.getenv("MINIO_TIMEOUT", "30"))
+MINIO_HTTP2 = os.getenv("MINIO_HTTP2", "false").lower() == "true"
+
+class_cache = get_class_cache("clusterbucketclasses")
+shards = get_shard_ring("minio-bucket-operator", "buckets")
+fingerprint = make_fingerprint(__file__)
+
+kopf.on.validate("buckets.codemowers.io", id="class", operations=["CREATE", "UPDATE"], ignore_failures=True)(
+    make_validator(class_cache))
+
+
+async def expected_objects(namespace, name, body):
+    """
+    Objects created for a bucket, the sweeper recreates missing ones
+    except for the cluster secret holding the root credentials in use
+    """
+    class_body = await class_cache.get(body["spec"]["class"])
+    expected = {("secrets", namespace, "bucket-%s-owner-secrets" % name): None}
+    if class_body["spec"].get("podSpec"):
+        target_namespace = class_body["spec"].get("targetNamespace", namespace)
+        instance = class_body["spec"].get("targetCluster", name)
+        if "targetNamespace" in class_body["spec"] and "targetCluster" not in class_body["spec"]:
+            instance = "%s-%s" % (namespace, instance)
+        service_name = "minio-cluster-%s" % instance
+        expected.update({
+            ("statefulsets", target_namespace, service_name): {"spec": {"replicas": class_body["spec"]["replicas"]}},
+            ("services", target_namespace, service_name): None,
+            ("services", target_namespace, "%s-headless" % service_name): None,
+            ("secrets", target_namespace, "%s-secrets" % service_name): Sweeper.GENERATED,
+        })
+    return expected
+
+
+# MinIO admin clients keyed by cluster base URL
+admins = {}
+
+
+class BufferedResponse(io.BytesIO):
+    """
+    Stand-in for the urllib3 response minio.crypto.decrypt expects
+    """
+    def release_conn(self):
+        pass
+
+
+class MinioAdmin(object):
+    """
+    Asynchronous client for the parts of MinIO admin REST API we need
+    """
+    def __init__(self, base_url, access_key, secret_key):
+        self.base_url = base_url
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.policies = set()
+        self.aws = AWS4Auth(
+            access_id=access_key,
+            secret_key=secret_key,
+            region="us-east-1",
+            service="s3")
+        self.requests = httpx.AsyncClient(
+            http2=MINIO_HTTP2,
+            timeout=MINIO_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=MINIO_MAX_CONNECTIONS,
+                max_keepalive_connections=MINIO_MAX_CONNECTIONS,
+                keepalive_expiry=MINIO_KEEPALIVE_EXPIRY))
+
+    async def close(self):
+        await self.requests.aclose()
+
+    async def request(self, method, command, params, content=None, json=None):
+        url = "%s/minio/admin/v3/%s" % (self.base_url, command)
+        r = await self.requests.request(method, url, params=params, content=content, json=json, auth=self.aws)
+        if r.status_code not in (200,):
+            raise Exception("MinIO admin command %s returned status code %d: %s" % (
+                command, r.status_code, r.text))
+        return r
+
+    async def user_add(self, access_key, secret_key):
+        # Request body is encrypted with the root secret key, the key derivation
+        # is deliberately expensive so keep it off the event loop
+        body = json.dumps({"status": "enabled", "secretKey": secret_key}).encode("ascii")
+        content = await asyncio.get_running_loop().run_in_executor(
+            None, encrypt, body, self.secret_key)
+        await self.request("PUT", "add-user", {"accessKey": access_key}, content=content)
+
+    async def policy_add(self, name, policy):
+        await self.request("PUT", "add-canned-policy", {"name": name}, content=policy.encode("ascii"))
+
+    async def policy_set(self, name, user):
+        # Upload the policy once per cluster, retry with fresh upload in case
+        # the cluster has been recreated in the meanwhile
+        for attempt in range(2):
+            if name not in self.policies:
+                await self.policy_add(name, OWNER_POLICY)
+                self.policies.add(name)
+            try:
+                await self.request("PUT", "set-user-or-group-policy", {
+                    "policyName": name, "userOrGroup": user, "isGroup": "false"})
+            except Exception:
+                if attempt:
+                    raise
+                self.policies.discard(name)
+            else:
+                return
+
+    async def set_bucket_quota(self, bucket, quota, quota_type):
+        await self.request("PUT", "set-bucket-quota", {"bucket": bucket}, json={
+            "quota": quota,
+            "quotatype": quota_type,
+        })
+
+    async def list_users(self):
+        # Response body is encrypted with the root secret key
+        r = await self.request("GET", "list-users", {})
+        body = await asyncio.get_running_loop().run_in_executor(
+            None, decrypt, BufferedResponse(r.content), self.secret_key)
+        return list(json.loads(body))
+
+    async def remove_user(self, access_key):
+        await self.request("DELETE", "remove-user", {"accessKey": access_key})
+
+    async def list_buckets(self):
+        r = await self.requests.get("%s/" % self.base_url, auth=self.aws)
+        if r.status_code not in (200,):
+            raise Exception("Listing buckets returned status code %d" % r.status_code)
+        return [e.text for e in ElementTree.fromstring(r.content).iter(
+            "{http://s3.amazonaws.com/doc/2006-03-01/}Name")]
+
+    async def remove_bucket(self, bucket):
+        # Objects of the bucket are removed as well
+        r = await self.requests.delete("%s/%s/" % (self.base_url, bucket), auth=self.aws,
+            headers={"x-minio-force-delete": "true"})
+        if r.status_code not in (204, 404):
+            raise Exception("Removing bucket returned status code %d" % r.status_code)
+
+
+def get_admin(base_url, access_key, secret_key):
+    """
+    Return pooled admin client for the MinIO cluster
+    """
+    admin = admins.get(base_url)
+    if admin and (admin.access_key, admin.secret_key) == (access_key, secret_key):
+        return admin
+    if admin:
+        # Root credentials have been changed
+        spawn(admin.close())
+    admin = admins[base_url] = MinioAdmin(base_url, access_key, secret_key)
+    return admin
+
+
+async def close_admin(base_url):
+    """
+    Close admin client of a MinIO cluster which is being torn down
+    """
+    admin = admins.pop(base_url, None)
+    if admin:
+        await admin.close()
+
+
+async def close_admins():
+    for base_url in list(admins):
+        await close_admin(base_url)
+
+
+at_shutdown(close_admins)
+
+
+def qualified_name(namespace, name):
+    """
+    Bucket name and access key for the Bucket
+    """
+    return "%s.%s" % (namespace, name)
+
+
+async def shared_cluster(class_spec):
+    """
+    Return admin client for the cluster shared by buckets of the class
+    """
+    target_namespace, instance = class_spec["targetNamespace"], class_spec["targetCluster"]
+    cluster_secrets = await read_credentials(
+        target_namespace, "minio-cluster-%s-secrets" % instance, True)
+    return get_admin(
+        "http://minio-cluster-%s.%s.svc.cluster.local" % (instance, target_namespace),
+        cluster_secrets["MINIO_ROOT_USER"],
+        cluster_secrets["MINIO_ROOT_PASSWORD"])
+
+
+async def enumerate_catalog(class_spec):
+    """
+    List buckets having a user of the same name on the shared cluster
+    """
+    if "targetNamespace" not in class_spec or "targetCluster" not in class_spec:
+        return None
+    admin = await shared_cluster(class_spec)
+    users = set(await admin.list_users())
+    return [name for name in await admin.list_buckets() if name in users and "." in name]
+
+
+async def drop_orphan(class_spec, name):
+    admin = await shared_cluster(class_spec)
+    async with get_cluster_semaphore((class_spec["targetNamespace"], class_spec["targetCluster"]),
+            class_spec.get("maxConcurrency")):
+        await admin.remove_user(name)
+        await admin.remove_bucket(name)
+
+
+@kopf.on.resume("buckets.codemowers.io", when=shards.owns)
+@kopf.on.create("buckets.codemowers.io", when=shards.owns)
+@fair
+async def creation(name, namespace, body, status, patch, **kwargs):
+    logging.info("Processing %s/%s" % (namespace, name))
+
+    timer = PhaseTimer()
+    class_body = await class_cache.get(body["spec"]["class"])
+    timer.mark("ClassResolved")
+
+    digest = fingerprint(body["spec"], class_body["spec"])
+    if await is_unchanged(status, digest, "/api/v1/namespaces/%s/secrets/bucket-%s-owner-secrets" % (namespace, name)):
+        logging.info("%s/%s unchanged since last run" % (namespace, name))
+        return
+
+    # Handle target namespace/cluster mapping
+    capacity = body["spec"]["capacity"]
+    expiration = body["spec"].get("expiration", 0)
+    quota_type = body["spec"].get("quotaType", "hard")
+    target_namespace = class_body["spec"].get("targetNamespace", namespace)
+    instance = class_body["spec"].get("targetCluster", name)
+    replicas = class_body["spec"]["replicas"]
+
+    # TODO: Make sure origin namespace/name do not contain dashes,
+    # or find some other trick to prevent name collisions
+
+    # Prefix instance name with origin namespace if
+    # we're hoarding instances into single namespace
+    if "targetNamespace" in class_body["spec"] and "targetCluster" not in class_body["spec"]:
+        instance = "%s-%s" % (namespace, instance)
+
+    # Service hostname and FQDN
+    service_name = "minio-cluster-%s" % instance
+    headless_name = "%s-headless" % service_name
+    service_fqdn = "%s.%s.svc.cluster.local" % (service_name, target_namespace)
+
+    # Derive owner object for Kopf
+    owner = body if target_namespace == namespace else class_body
+
+    # Pod labels
+    labels, label_selector = make_selector("minio", instance)
+
+    # Construct secret for cluster secrets
+    sec = Secret(target_namespace, "minio-cluster-%s-secrets" % instance)
+
+    cluster_secrets = None
+
+    # If there is no pod spec, the Minio cluster must be outside Kubernetes cluster
+    pod_spec = thaw(class_body["spec"].get("podSpec", None))
+    if pod_spec:
+        # AZ handling
+        pod_spec["affinity"] = {
+            "podAntiAffinity": {
+                "requiredDuringSchedulingIgnoredDuringExecution": [{
+                    "labelSelector": label_selector,
+                    "topologyKey": class_body["spec"].get("topologyKey", "topology.kubernetes.io/zone")
+                }]
+            }
+        }
+
+        # Cluster secrets
+        secret_body = await sec.wrap([{
+            "key": "MINIO_ROOT_USER",
+            "value": "root"
+        }, {
+            "key": "MINIO_ROOT_PASSWORD",
+            "value": "%(plaintext)s",
+        }, {
+            "key": "MINIO_URI",
+            "value": "http://root:%(plaintext)s@" + service_fqdn
+        }, {
+            "key": "AWS_S3_ENDPOINT_URL",
+            "value": "http://%s" % service_fqdn
+        }], labels)
+
+        kopf.append_owner_reference(secret_body, owner, block_owner_deletion=False)
+
+        # Stateful set
+        container_spec = pod_spec["containers"][0]
+        container_spec["args"].append("http://%s-{0...%d}.%s.%s.svc.cluster.local/data" % (
+            service_name, replicas - 1, headless_name, target_namespace))
+        container_spec["envFrom"] = [{
+            "secretRef": {
+                "name": sec.name
+            }
+        }]
+
+        statefulset_body = {
+            "apiVersion": "apps/v1",
+            "kind": "StatefulSet",
+            "metadata": {
+                "namespace": target_namespace,
+                "name": "minio-cluster-%s" % instance,
+                "labels": labels,
+            },
+            "spec": {
+                "selector": {
+                    "matchLabels": labels,
+                },
+                "serviceName": headless_name,
+                "replicas": replicas,
+                "podManagementPolicy": "Parallel",
+                "template": {
+                    "metadata": {
+                        "labels": labels,
+                    },
+                    "spec": pod_spec,
+                },
+                "volumeClaimTemplates": [{
+                    "metadata": {
+                        "name": "data",
+                    },
+                    "spec": {
+                        "accessModes": ["ReadWriteOnce"],
+                        "resources": {
+                            "requests": {
+                                "storage": capacity,
+                            }
+                        },
+                        "storageClassName": class_body["spec"]["storageClass"],
+                    }
+                }]
+            }
+        }
+
+        kopf.append_owner_reference(statefulset_body, owner, block_owner_deletion=False)
+
+        # Service
+        service_body = {
+            "kind": "Service",
+            "apiVersion": "v1",
+            "metadata": {
+                "namespace": target_namespace,
+                "name": service_name,
+                "labels": labels,
+            },
+            "spec": {
+                "selector": labels,
+                "sessionAffinity": "ClientIP",
+                "type": "ClusterIP",
+                "ports": [{
+                    "port": 80,
+                    "targetPort": 9000,
+                    "name": "http",
+                }]
+            }
+
+        }
+        kopf.append_owner_reference(service_body, owner, block_owner_deletion=False)
+
+        # Headless service
+        headless_body = {
+            "kind": "Service",
+            "apiVersion": "v1",
+            "metadata": {
+                "namespace": target_namespace,
+                "name": headless_name,
+                "labels": labels,
+            },
+            "spec": {
+                "selector": labels,
+                "clusterIP": "None",
+                "publishNotReadyAddresses": True,
+                "ports": [{
+                    "name": "http",
+                    "port": 9000
+                }]
+            }
+        }
+
+        kopf.append_owner_reference(headless_body, owner, block_owner_deletion=False)
+
+        # Create cluster secret before the stateful set referring to it,
+        # services can be created concurrently
+        graph = ResourceGraph(FIELD_MANAGER)
+        graph.add("secret", secret_body, generated=True)
+        graph.add("statefulset", statefulset_body, depends=("secret",))
+        graph.add("service", service_body)
+        graph.add("headless", headless_body)
+        await graph.apply()
+        timer.mark("ClusterApplied")
+        if graph.results["secret"]:
+            cluster_secrets = decode_secret(graph.results["secret"]["data"])
+
+    # Fetch secrets to create bucket
+    if not cluster_secrets:
+        logging.info("Reading minio cluster secrets %s/%s" % (target_namespace, sec.name))
+        cluster_secrets = await read_credentials(
+            target_namespace, sec.name, "targetCluster" in class_body["spec"])
+
+    # Create bucket
+    bucket_name = access_key = qualified_name(namespace, name)
+    base_url = "http://%s" % service_fqdn
+    admin = get_admin(
+        base_url,
+        cluster_secrets["MINIO_ROOT_USER"],
+        cluster_secrets["MINIO_ROOT_PASSWORD"])
+    aws = admin.aws
+    requests = admin.requests
+
+    semaphore = get_cluster_semaphore((target_namespace, instance), class_body["spec"].get("maxConcurrency"))
+
+    url = "%s/%s/" % (base_url, bucket_name)
+    logging.info("Creating bucket %s with " % url)
+    async with semaphore:
+        r = await requests.put(url, auth=aws)
+    if r.status_code not in (200, 409):
+        raise Exception("Creating bucket returned status code %d" % r.status_code)
+
+    '''
+    # Following returns HTTP status code 400 for some reason
+    # Set expiration
+    rules = """<?xml version="1.0" encoding="UTF-8"?>
+      <LifecycleConfiguration xmlns="http://s3.amazonaws.com/doc/2006-03-01/">
+        <Rule>
+          <Expiration>
+            <Days>%d</Days>
+          </Expiration>
+          <ID>bucket-operator</ID>
+          <Filter>
+            <Prefix></Prefix>
+          </Filter>
+          <Status>Enabled</Status>
+        </Rule>
+      </LifecycleConfiguration>""" % expiration
+
+    # Set expiration
+    r = await requests.put(url + "?lifecycle", auth=aws,
+        headers={"Content-Type": "application/xml"},
+        data="<LifecycleConfiguration>%s</LifecycleConfiguration>" % (rules if expiration else ""))
+    if r.status_code not in (200,):
+        raise Exception("Setting expiration for bucket returned status code %d" % r.status_code)
+    '''
+
+    # Set quota
+    logging.info("Setting quota of %s to %s (%s)" % (bucket_name, capacity, quota_type))
+    async with semaphore:
+        await admin.set_bucket_quota(bucket_name, parse_capacity(capacity), quota_type)
+    timer.mark("BucketCreated")
+
+    # TODO: Add network policy
+    # TODO: Add ingress
+
+    # Create secret for accessing bucket
+    bucket_secrets = Secret(namespace, "bucket-%s-owner-secrets" % name)
+    body = await bucket_secrets.wrap([{
+        "key": "BASE_URI",
+        "value": "http://%s/%s/" % (service_fqdn, bucket_name)
+    }, {
+        "key": "BUCKET_NAME",
+        "value": bucket_name
+    }, {
+        "key": "AWS_S3_ENDPOINT_URL",
+        "value": cluster_secrets["AWS_S3_ENDPOINT_URL"]
+    }, {
+        "key": "AWS_DEFAULT_REGION",
+        "value": "us-east-1"
+    }, {
+        "key": "AWS_ACCESS_KEY_ID",
+        "value": access_key
+    }, {
+        "key": "AWS_SECRET_ACCESS_KEY",
+        "value": "%(plaintext)s",
+    }, {
+        "key": "MINIO_URI",
+        "value": "http://%s:%%(plaintext)s@%s" % (access_key, service_fqdn),
+    }], labels)
+    timer.mark("SecretGenerated")
+
+    kopf.append_owner_reference(body, owner, block_owner_deletion=False)
+
+    # Use the stored secret in case last run was interrupted
+    secrets = decode_secret((await ensure_resource(body))["data"])
+    access_key = secrets["AWS_ACCESS_KEY_ID"]
+    secret_key = secrets["AWS_SECRET_ACCESS_KEY"]
+    timer.mark("CredentialsPublished")
+
+    # Add user and set the owner read-write policy for the bucket
+    logging.info("Creating user %s" % access_key)
+    async with semaphore:
+        await admin.user_add(access_key, secret_key)
+        await admin.policy_set("owner", access_key)
+    timer.mark("UserCreated")
+
+    patch.status["conditions"] = timer.conditions()
+    return {"state": "READY", "fingerprint": digest, "latency": round(timer.elapsed, 3)}
+
+
+@kopf.on.delete("buckets.codemowers.io")
+async def deletion(name, namespace, body, **kwargs):
+    paths = ["/api/v1/namespaces/%s/secrets/bucket-%s-owner-secrets" % (namespace, name)]
+    class_body = await class_cache.get(body["spec"]["class"], missing_ok=True)
+    if not class_body:
+        # Nothing else can be located without the class, objects owned
+        # by this one or the class are left to the garbage collector
+        await tear_down(paths)
+        return
+    target_namespace = class_body["spec"].get("targetNamespace", namespace)
+
+    # Buckets on shared clusters are removed by the reclaimer
+    if class_body["spec"].get("podSpec") and "targetCluster" not in class_body["spec"]:
+        instance = name
+        if "targetNamespace" in class_body["spec"]:
+            instance = "%s-%s" % (namespace, instance)
+        service_name = "minio-cluster-%s" % instance
+        paths += [
+            "/apis/apps/v1/namespaces/%s/statefulsets/%s" % (target_namespace, service_name),
+            "/api/v1/namespaces/%s/services/%s" % (target_namespace, service_name),
+            "/api/v1/namespaces/%s/services/%s-headless" % (target_namespace, service_name),
+            "/api/v1/namespaces/%s/secrets/%s-secrets" % (target_namespace, service_name),
+        ]
+        await close_admin("http://%s.%s.svc.cluster.local" % (service_name, target_namespace))
+    await tear_down(paths, target_namespace == namespace)
+
+
+@kopf.index("buckets.codemowers.io")
+async def buckets_by_class(namespace, name, spec, **_):
+    return {spec["class"]: (namespace, name)}
+
+
+@kopf.on.update("clusterbucketclasses.codemowers.io", field="spec")
+async def class_update(name, body, buckets_by_class, **_):
+    # Reconcile only objects of this replica referring to the class with the new spec
+    class_cache.put(body)
+    await roll_out([key for key in buckets_by_class.get(name, ()) if shards.owns(*key)], "buckets", creation)
+
+
+@kopf.on.startup()
+async def configure(settings: kopf.OperatorSettings, **_):
+    if os.getenv("KUBECONFIG"):
+        await config.load_kube_config()
+    else:
+        config.load_incluster_config()
+    await open_api_client()
+    settings.scanning.disabled = True
+    # Events are posted by the aggregating event sink instead
+    settings.posting.enabled = False
+    open_event_sink("minio-operator")
+    configure_webhook(settings, "minio-bucket-operator")
+    settings.persistence.finalizer = FIELD_MANAGER
+    await open_shard_ring(settings, shards, creation)
+    spawn(Sweeper("buckets", creation, expected_objects, {"app.kubernetes.io/name": "minio"}, shards.owns).run())
+    spawn(Reclaimer("buckets", "clusterbucketclasses",
+        qualified_name, enumerate_catalog, drop_orphan, shards.owns).run())
+    logging.info("minio-operator starting up")
+
+
+@kopf.on.cleanup()
+async def cleanup(**_):
+    await shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(kopf.operator(clusterwide=True))
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Run a selection of operators in a single process on one event loop, so that
+the Kubernetes API client, caches and rate limits of lib are shared instead of
+being set up once per operator process. Only modules of selected operators
+are imported and with them only the database drivers they need
+"""
+import asyncio
+import importlib.util
+import kopf
+import logging
+import os
+import signal
+import sys
+from lib import WEBHOOK_PORT, make_webhook_server, open_event_sink
+
+OPERATORS = ("redis", "bucket", "postgres", "mysql", "secret")
+
+# Operators serving admission webhooks, each gets port of its own counting
+# from WEBHOOK_PORT in this order regardless of which operators are selected,
+# all of them reached via service named WEBHOOK_SERVICE
+WEBHOOKS = ("redis", "bucket", "postgres", "mysql")
+WEBHOOK_SERVICE = os.getenv("WEBHOOK_SERVICE", "operator-bundle")
+
+
+def load(name):
+    """
+    Import operator module with its handlers registered to a registry of its own,
+    the module gets a suffix so that it does not end up in place of a package
+    of the same name such as redis
+    """
+    registry = kopf.OperatorRegistry()
+    kopf.set_default_registry(registry)
+    spec = importlib.util.spec_from_file_location(
+        "%s_operator" % name,
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), "%s.py" % name))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return registry
+
+
+async def main(registries):
+    ignored = asyncio.all_tasks()
+    open_event_sink("operator-bundle")
+    stop_flag = asyncio.Event()
+    tasks = []
+    for name, registry in registries.items():
+        settings = kopf.OperatorSettings()
+        if WEBHOOK_PORT and name in WEBHOOKS:
+            settings.admission.server = make_webhook_server(
+                WEBHOOK_SERVICE, WEBHOOK_PORT + WEBHOOKS.index(name))
+        tasks.extend(await kopf.spawn_tasks(
+            registry=registry,
+            settings=settings,
+            clusterwide=True,
+            stop_flag=stop_flag))
+
+    # Every operator installed signal handlers for its own tasks only,
+    # replace them with ones stopping all of the operators at once
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop_flag.set)
+
+    # Tasks of all operators are run together, once any root task exits
+    # the rest are stopped as well and the pod gets restarted as a whole
+    await kopf.run_tasks(tasks, ignored=ignored)
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or os.getenv("OPERATORS", ",".join(OPERATORS)).split(",")
+    names = [name.strip() for name in names if name.strip()]
+    unknown = set(names) - set(OPERATORS)
+    if unknown:
+        sys.exit("Unknown operators %s, expected some of %s" % (
+            ", ".join(sorted(unknown)), ", ".join(OPERATORS)))
+    registries = {}
+    for name in OPERATORS:
+        if name in names:
+            registries[name] = load(name)
+    logging.info("Running operators %s in single process" % ", ".join(registries))
+    asyncio.run(main(registries))
@@ -1,10 +1,150 @@
+import aiohttp
+import asyncio
+import contextlib
+import contextvars
+import datetime
+import functools
+import hashlib
+import heapq
+import inspect
+import itertools
+import json
+import kopf
+import logging
+import os
+import ssl
 import string
 import random
-from base64 import b64encode
+import re
+import time
+from base64 import b64decode, b64encode
+from collections import Counter, deque
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 from kubernetes_asyncio import client
+from kubernetes_asyncio.client.exceptions import ApiException
+from kubernetes_asyncio.client.rest import RESTResponse
 from passlib.context import CryptContext
+from passlib.hash import argon2, bcrypt
+from urllib.parse import urlencode
 
-bcrypt_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Cost factors for derived secret formats
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+ARGON2_TIME_COST = int(os.getenv("ARGON2_TIME_COST", "3"))
+ARGON2_MEMORY_COST = int(os.getenv("ARGON2_MEMORY_COST", "65536"))
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", str(os.cpu_count() or 1)))
+
+# Connection pool tunables for the shared Kubernetes API client
+KUBE_POOL_MAXSIZE = int(os.getenv("KUBE_POOL_MAXSIZE", "32"))
+KUBE_KEEPALIVE_TIMEOUT = float(os.getenv("KUBE_KEEPALIVE_TIMEOUT", "60"))
+
+# Admin connection pool tunables for database clusters
+ADMIN_POOL_MAXSIZE = int(os.getenv("ADMIN_POOL_MAXSIZE", "4"))
+ADMIN_POOL_IDLE_TIMEOUT = float(os.getenv("ADMIN_POOL_IDLE_TIMEOUT", "300"))
+
+# Window for collecting provisioning requests into a single batch
+PROVISIONING_WINDOW = float(os.getenv("PROVISIONING_WINDOW", "0.2"))
+PROVISIONING_BATCH_SIZE = int(os.getenv("PROVISIONING_BATCH_SIZE", "100"))
+
+# How long handlers wait for dependent objects to become ready
+# before giving up and letting Kopf retry the handler
+READINESS_TIMEOUT = float(os.getenv("READINESS_TIMEOUT", "600"))
+
+# Number of dependents re-reconciled concurrently after a class change
+CLASS_ROLLOUT_CONCURRENCY = int(os.getenv("CLASS_ROLLOUT_CONCURRENCY", "8"))
+
+# Simultaneous provisioning operations per backend cluster unless
+# maxConcurrency is specified by the class
+CLUSTER_MAX_CONCURRENCY = int(os.getenv("CLUSTER_MAX_CONCURRENCY", "2"))
+
+# Fair scheduling of handlers between origin namespaces, weights
+# are given as comma separated namespace=weight pairs
+FAIR_MAX_IN_FLIGHT = int(os.getenv("FAIR_MAX_IN_FLIGHT", "32"))
+FAIR_NAMESPACE_MAX_IN_FLIGHT = int(os.getenv("FAIR_NAMESPACE_MAX_IN_FLIGHT", "4"))
+FAIR_WEIGHTS = dict(
+    (key.strip(), int(value)) for key, value in (
+        pair.split("=") for pair in os.getenv("FAIR_WEIGHTS", "").split(",") if pair.strip()))
+
+# Client-side rate limits for API server requests, reads and writes
+# have separate token buckets refilled at QPS up to BURST tokens
+KUBE_READ_QPS = float(os.getenv("KUBE_READ_QPS", "50"))
+KUBE_READ_BURST = int(os.getenv("KUBE_READ_BURST", "100"))
+KUBE_WRITE_QPS = float(os.getenv("KUBE_WRITE_QPS", "20"))
+KUBE_WRITE_BURST = int(os.getenv("KUBE_WRITE_BURST", "40"))
+
+# Priorities of throttled requests, lower is served first
+PRIORITY_URGENT = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2
+
+# Kubernetes events posted for log messages of handlers, messages below
+# EVENT_LEVEL are not posted, identical messages are aggregated and
+# posted every EVENT_FLUSH_INTERVAL seconds, at most EVENT_BUDGET per flush
+EVENT_LEVEL = logging.getLevelName(os.getenv("EVENT_LEVEL", "WARNING").upper())
+EVENT_FLUSH_INTERVAL = float(os.getenv("EVENT_FLUSH_INTERVAL", "10"))
+EVENT_BUDGET = int(os.getenv("EVENT_BUDGET", "20"))
+
+# Sharding of objects between operator replicas, replicas heartbeat to
+# a peering object every SHARD_HEARTBEAT_INTERVAL seconds and are
+# considered gone after not being seen for SHARD_LIFETIME seconds
+SHARDING = os.getenv("SHARDING", "false").lower() == "true"
+SHARD_HEARTBEAT_INTERVAL = float(os.getenv("SHARD_HEARTBEAT_INTERVAL", "10"))
+SHARD_LIFETIME = float(os.getenv("SHARD_LIFETIME", "30"))
+
+# Periodic sweep recreating objects deleted or changed behind the back of
+# the operator, each kind is listed in pages of SWEEP_PAGE_SIZE objects
+SWEEP_INTERVAL = float(os.getenv("SWEEP_INTERVAL", "300"))
+SWEEP_PAGE_SIZE = int(os.getenv("SWEEP_PAGE_SIZE", "500"))
+
+# Reclamation of databases, users and buckets left behind on shared clusters
+# by deleted custom resources, orphans are dropped once they have been seen
+# for RECLAIM_GRACE_PERIOD seconds and only with RECLAIM_DRY_RUN disabled
+RECLAIM_INTERVAL = float(os.getenv("RECLAIM_INTERVAL", "3600"))
+RECLAIM_GRACE_PERIOD = float(os.getenv("RECLAIM_GRACE_PERIOD", "86400"))
+RECLAIM_DRY_RUN = os.getenv("RECLAIM_DRY_RUN", "true").lower() == "true"
+
+# Admission webhook served by the operator process, reached via service
+# named after the operator in the namespace the operator runs in,
+# WEBHOOK_PORT set to 0 disables the webhook
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "9443"))
+WEBHOOK_NAMESPACE = os.getenv("POD_NAMESPACE", "operator-bundle")
+
+# Certificate of the webhook server shared by replicas, without it each
+# replica generates its own and replaces the CA bundle the others rely on
+WEBHOOK_CAFILE = os.getenv("WEBHOOK_CAFILE")
+WEBHOOK_CERTFILE = os.getenv("WEBHOOK_CERTFILE")
+WEBHOOK_PKEYFILE = os.getenv("WEBHOOK_PKEYFILE")
+
+# Timeouts for raw API requests, watches are expected to receive
+# bookmarks regularly so a silent connection is considered dead
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=300)
+WATCH_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_read=300)
+
+# Converge generated objects with server-side apply instead of create-only
+SERVER_SIDE_APPLY = os.getenv("SERVER_SIDE_APPLY", "false").lower() == "true"
+
+# Leave objects owned by a deleted custom resource to the garbage collector
+# instead of deleting them explicitly from the deletion handler
+TEARDOWN_VIA_OWNER_REFERENCES = os.getenv("TEARDOWN_VIA_OWNER_REFERENCES", "true").lower() == "true"
+
+_api_client = None
+_api_client_users = 0
+_tasks = set()
+_class_caches = {}
+_credential_cache = None
+_closers = []
+_hash_executor = None
+_schedulers = {}
+_fair_slot = contextvars.ContextVar("fair_slot", default=None)
+_rate_limiters = {}
+_cluster_semaphores = {}
+_event_sink = None
+_shard_rings = {}
 
 
 def parse_capacity(s):
@@ -47,12 +187,52 @@ def make_selector(application_name, instance_name):
     return labels, selector
 
 
+def derived_formats(rounds):
+    """
+    Return derived formats available in secret mappings, eg. %(bcrypt)s,
+    hashing with the given bcrypt cost factor
+    """
+    return {
+        "bcrypt": CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=rounds).hash,
+        # Apache htpasswd recognizes only the $2y$ flavour of bcrypt
+        "htpasswd": bcrypt.using(rounds=rounds, ident="2y").hash,
+        "sha256": lambda value: hashlib.sha256(value.encode("ascii")).hexdigest(),
+        # Requires argon2-cffi
+        "argon2": lambda value: argon2.using(
+            time_cost=ARGON2_TIME_COST, memory_cost=ARGON2_MEMORY_COST).hash(value),
+    }
+
+
+DERIVED_FORMATS = derived_formats(BCRYPT_ROUNDS)
+
+
+def get_hash_executor():
+    """
+    Return thread pool for computing derived secret formats,
+    bcrypt and argon2 release the GIL so hashes are computed in parallel
+    """
+    global _hash_executor
+    if not _hash_executor:
+        _hash_executor = ThreadPoolExecutor(HASH_WORKERS, thread_name_prefix="hash")
+    return _hash_executor
+
+
+async def _shutdown_hash_executor():
+    global _hash_executor
+    if _hash_executor:
+        _hash_executor.shutdown(wait=False, cancel_futures=True)
+        _hash_executor = None
+
+
 class Secret(object):
+    formats = DERIVED_FORMATS
+
     def __init__(self, namespace, name, value=None, size=32):
         self.namespace = namespace
         self.name = name
         self.size = size
         self._value = value
+        self._derived = {}
 
     @property
     def value(self):
@@ -67,41 +247,1375 @@ class Secret(object):
             return self.name
         elif key in ("plaintext", "password"):
             return self.value
-        elif key == "bcrypt":
-            return bcrypt_context.hash(self.value)
+        elif key in self.formats:
+            try:
+                return self._derived[key]
+            except KeyError:
+                derived = self._derived[key] = self.formats[key](self.value)
+                return derived
+
+    async def wrap(self, mapping, labels=None):
+        # Compute derived formats referenced by the mapping in the thread pool
+        keys = set()
+        for o in mapping:
+            keys.update(re.findall(r"%\((\w+)\)s", o["value"]))
+        keys = [key for key in keys if key in self.formats and key not in self._derived]
+        if keys:
+            loop = asyncio.get_running_loop()
+            value = self.value
+            derived = await asyncio.gather(*[
+                loop.run_in_executor(get_hash_executor(), self.formats[key], value) for key in keys])
+            self._derived.update(zip(keys, derived))
 
-    def wrap(self, mapping):
         data = {}
         for o in mapping:
             data[o["key"]] = b64encode((o["value"] % self).encode("ascii")).decode("ascii")
-        kwargs = {
-            "api_version": "v1",
+        return {
+            "apiVersion": "v1",
             "data": data,
             "kind": "Secret",
             "metadata": {
-                "name": self.name
+                "name": self.name,
+                "namespace": self.namespace,
+                "labels": labels or {},
             }
         }
-        return kwargs
 
 
+# Minimal cost factor keeps the check from slowing down every import
 s = Secret("foo", "bar")
+s.formats = derived_formats(4)
 assert s["namespace"] == "foo"
 assert s["name"] == "bar"
 assert len(s["plaintext"]) == 32
 assert len(s["bcrypt"]) == 60
+assert s["bcrypt"] == s["bcrypt"]
+assert len(s["sha256"]) == 64
+assert s["htpasswd"].startswith("$2y$")
+
+
+async def open_api_client():
+    """
+    Set up process-wide Kubernetes API client, to be called from
+    the startup hook once the kubeconfig has been loaded, operators
+    sharing a process share the client until the last one shuts down
+    """
+    global _api_client, _api_client_users
+    _api_client_users += 1
+    if _api_client:
+        return _api_client
+    configuration = client.Configuration.get_default_copy()
+    configuration.connection_pool_maxsize = KUBE_POOL_MAXSIZE
+    api_client = client.ApiClient(configuration)
+
+    # Replace the session set up by kubernetes_asyncio with one
+    # which keeps idle connections around for longer
+    ssl_context = ssl.create_default_context(cafile=configuration.ssl_ca_cert)
+    if configuration.cert_file:
+        ssl_context.load_cert_chain(configuration.cert_file, keyfile=configuration.key_file)
+    if not configuration.verify_ssl:
+        ssl_context.check_hostname = False
+        ssl_context.verify_mode = ssl.CERT_NONE
+    # Swap the session before yielding to the event loop so that
+    # concurrent startup hooks of a bundle pick up the same client
+    pool_manager = api_client.rest_client.pool_manager
+    api_client.rest_client.pool_manager = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=KUBE_POOL_MAXSIZE,
+            keepalive_timeout=KUBE_KEEPALIVE_TIMEOUT,
+            ssl=ssl_context),
+        trust_env=True,
+        read_bufsize=2 ** 21)
+    _api_client = api_client
+    await pool_manager.close()
+    logging.info("Kubernetes API client pool size %d, keep-alive %.1fs" % (
+        KUBE_POOL_MAXSIZE, KUBE_KEEPALIVE_TIMEOUT))
+    spawn(_report_rate_limits())
+    return api_client
+
+
+def get_api_client():
+    """
+    Return the shared Kubernetes API client
+    """
+    if not _api_client:
+        raise RuntimeError("API client not set up, call open_api_client() from startup hook")
+    return _api_client
+
+
+def spawn(coro):
+    """
+    Run coroutine in background until shutdown
+    """
+    task = asyncio.create_task(coro)
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return task
+
+
+def at_shutdown(closer):
+    """
+    Register coroutine function to be awaited on shutdown
+    """
+    _closers.append(closer)
+    return closer
+
+
+async def shutdown():
+    """
+    Release resources held by the shared machinery, to be called
+    from the cleanup hook, does nothing until the last operator
+    sharing the process has shut down
+    """
+    global _api_client, _api_client_users
+    _api_client_users -= 1
+    if _api_client_users > 0:
+        return
+    for task in list(_tasks):
+        task.cancel()
+    await asyncio.gather(*_tasks, return_exceptions=True)
+    for closer in _closers:
+        await closer()
+    await close_event_sink()
+    await _shutdown_hash_executor()
+    for cache in _class_caches.values():
+        logging.info("Class cache %s: %d hits, %d misses" % (
+            cache.plural, cache.hits, cache.misses))
+    if _credential_cache:
+        logging.info("Credential cache: %d hits, %d misses" % (
+            _credential_cache.hits, _credential_cache.misses))
+    for limiter in _rate_limiters.values():
+        logging.info(limiter.stats())
+    if _api_client:
+        await _api_client.close()
+        _api_client = None
+
+
+class EventSink(logging.Handler):
+    """
+    Post messages of Kopf object loggers as Kubernetes events. Identical
+    messages for the same object are aggregated into a single event with
+    a count, events are posted in batches by flush() within EVENT_BUDGET,
+    warnings and most repeated messages first, the rest are dropped
+    """
+    def __init__(self, component):
+        super().__init__(EVENT_LEVEL)
+        self.component = component
+        self.instance = os.getenv("HOSTNAME", component)
+        self.pending = {}
+        self.posted = 0
+        self.aggregated = 0
+        self.dropped = 0
+
+    def emit(self, record):
+        ref = getattr(record, "k8s_ref", None)
+        if not ref or getattr(record, "k8s_skip", False) or ref.get("kind") == "Event":
+            return
+        event_type = "Normal" if record.levelno <= logging.INFO else "Warning"
+        message = record.getMessage()
+        if len(message) > 1024:
+            message = message[:510] + "..." + message[-511:]
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        key = ref.get("uid"), event_type, message
+        try:
+            event = self.pending[key]
+        except KeyError:
+            namespace = ref.get("namespace") or "default"
+            self.pending[key] = {
+                "apiVersion": "v1",
+                "kind": "Event",
+                "metadata": {
+                    "namespace": namespace,
+                    "generateName": "%s." % (ref.get("name") or "event"),
+                },
+                "type": event_type,
+                "reason": "Logging",
+                "message": message,
+                "count": 1,
+                "involvedObject": dict(ref, namespace=namespace),
+                "reportingComponent": self.component,
+                "reportingInstance": self.instance,
+                "source": {"component": self.component},
+                "firstTimestamp": now,
+                "lastTimestamp": now,
+            }
+        else:
+            event["count"] += 1
+            event["lastTimestamp"] = now
+            self.aggregated += 1
+
+    async def flush(self):
+        pending, self.pending = self.pending, {}
+        batch = sorted(pending.values(), key=lambda e: (e["type"] == "Normal", -e["count"]))
+        self.dropped += len(batch[EVENT_BUDGET:])
+        batch = batch[:EVENT_BUDGET]
+        results = await asyncio.gather(*[
+            api_request("POST", "/api/v1/namespaces/%s/events" % event["metadata"]["namespace"], event)
+            for event in batch], return_exceptions=True)
+        for event, result in zip(batch, results):
+            if isinstance(result, Exception):
+                # Logged via root logger so that failures are not posted as events
+                logging.warning("Failed to post event for %s %s/%s: %s" % (
+                    event["involvedObject"].get("kind"), event["metadata"]["namespace"],
+                    event["involvedObject"].get("name"), result))
+            else:
+                self.posted += 1
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(EVENT_FLUSH_INTERVAL)
+            await self.flush()
+
+
+def open_event_sink(component):
+    """
+    Post events for object log messages through the aggregating sink,
+    to be called from the startup hook with Kopf posting disabled
+    """
+    global _event_sink
+    if _event_sink:
+        return _event_sink
+    _event_sink = EventSink(component)
+    logging.getLogger("kopf.objects").addHandler(_event_sink)
+    spawn(_event_sink.run())
+    return _event_sink
+
+
+async def close_event_sink():
+    global _event_sink
+    if not _event_sink:
+        return
+    logging.getLogger("kopf.objects").removeHandler(_event_sink)
+    await _event_sink.flush()
+    logging.info("Event sink: %d events posted, %d messages aggregated, %d dropped" % (
+        _event_sink.posted, _event_sink.aggregated, _event_sink.dropped))
+    _event_sink = None
+
+
+class FrozenDict(dict):
+    """
+    Read-only dict handed out by caches, use thaw() to get a mutable copy
+    """
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("Cached object is read-only, use thaw() to get a mutable copy")
+
+    __setitem__ = __delitem__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+
+def freeze(obj):
+    if isinstance(obj, Mapping):
+        return FrozenDict((key, freeze(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return tuple(freeze(value) for value in obj)
+    return obj
+
+
+def thaw(obj):
+    if isinstance(obj, Mapping):
+        return dict((key, thaw(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return [thaw(value) for value in obj]
+    return obj
+
+
+frozen = freeze({"spec": {"podSpec": {"containers": [{"args": []}]}}})
+try:
+    frozen["spec"]["podSpec"]["affinity"] = {}
+except TypeError:
+    pass
+else:
+    assert False, "Frozen dict should not be mutable"
+assert thaw(frozen) == {"spec": {"podSpec": {"containers": [{"args": []}]}}}
+thawed = thaw(frozen)
+thawed["spec"]["podSpec"]["containers"][0]["args"].append("--save")
+assert frozen["spec"]["podSpec"]["containers"][0]["args"] == ()
+
+
+async def watch_objects(path, **params):
+    """
+    List objects and follow changes, yields ("LIST", objects) after every
+    (re)list followed by ("ADDED"|"MODIFIED"|"DELETED", object) pairs.
+    Objects are plain dicts as returned by the API server
+    """
+    while True:
+        try:
+            listing = await api_request("GET", path, query_params=list(params.items()))
+            yield "LIST", listing["items"]
+            resource_version = listing["metadata"]["resourceVersion"]
+            while True:
+                async with api_stream("GET", path, query_params=[
+                        *params.items(),
+                        ("watch", "true"),
+                        ("allowWatchBookmarks", "true"),
+                        ("resourceVersion", resource_version)], timeout=WATCH_TIMEOUT) as response:
+                    async for line in response.content:
+                        event = json_loads(line)
+                        obj = event["object"]
+                        if event["type"] == "ERROR":
+                            # Most likely 410 Gone, resume with a fresh listing
+                            raise ApiException(status=obj.get("code"), reason=obj.get("message"))
+                        resource_version = obj["metadata"]["resourceVersion"]
+                        if event["type"] != "BOOKMARK":
+                            yield event["type"], obj
+        except asyncio.CancelledError:
+            raise
+        except (ApiException, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.warning("Watch of %s interrupted: %s" % (path, e))
+            await asyncio.sleep(5)
+
+
+async def list_objects(path, **params):
+    """
+    Iterate over objects of a listing fetched in pages
+    """
+    token = None
+    while True:
+        query_params = [*params.items(), ("limit", SWEEP_PAGE_SIZE)]
+        if token:
+            query_params.append(("continue", token))
+        listing = await api_request("GET", path, query_params=query_params)
+        for obj in listing["items"]:
+            yield obj
+        token = listing["metadata"].get("continue")
+        if not token:
+            break
+
+
+async def wait_for_object(path, name, condition=None, timeout=None):
+    """
+    Wait until named object under the collection path exists and satisfies
+    the condition, returns the object. The object is watched so the caller
+    resumes as soon as it becomes ready instead of after retry backoff
+    """
+    async def wait():
+        async with contextlib.aclosing(watch_objects(
+                path, fieldSelector="metadata.name=%s" % name)) as events:
+            async for event_type, obj in events:
+                if event_type == "LIST":
+                    candidates = obj
+                elif event_type in ("ADDED", "MODIFIED"):
+                    candidates = [obj]
+                else:
+                    continue
+                for candidate in candidates:
+                    if not condition or condition(candidate):
+                        return candidate
+
+    timeout = timeout or READINESS_TIMEOUT
+    started = asyncio.get_running_loop().time()
+    try:
+        async with released():
+            obj = await asyncio.wait_for(wait(), timeout)
+    except asyncio.TimeoutError:
+        raise kopf.TemporaryError("%s/%s not ready after %ds" % (path, name, timeout), delay=10)
+    elapsed = asyncio.get_running_loop().time() - started
+    if elapsed > 1:
+        logging.info("Waited %.1fs for %s/%s" % (elapsed, path, name))
+    return obj
+
+
+def endpoints_ready(obj):
+    """
+    Condition for wait_for_object, true if service endpoints have addresses
+    """
+    return any(subset.get("addresses") for subset in obj.get("subsets") or ())
+
+
+assert endpoints_ready({"subsets": [{"notReadyAddresses": [{"ip": "10.0.0.1"}]}, {"addresses": [{"ip": "10.0.0.2"}]}]})
+assert not endpoints_ready({"subsets": [{"notReadyAddresses": [{"ip": "10.0.0.1"}]}]})
+assert not endpoints_ready({"metadata": {"name": "foo"}})
+
+
+class ClassCache(object):
+    """
+    Cluster-scoped class objects kept up to date by a watch
+    """
+    def __init__(self, plural, version):
+        self.plural = plural
+        self.version = version
+        self.path = "/apis/codemowers.io/%s/%s" % (version, plural)
+        self.objects = {}
+        self.hits = 0
+        self.misses = 0
+        self._watcher = None
+
+    async def _watch(self):
+        async for event_type, obj in watch_objects(self.path):
+            if event_type == "LIST":
+                self.objects = dict((o["metadata"]["name"], freeze(o)) for o in obj)
+            elif event_type == "DELETED":
+                self.objects.pop(obj["metadata"]["name"], None)
+            elif event_type in ("ADDED", "MODIFIED"):
+                self.put(obj)
+
+    def put(self, body):
+        """
+        Store class object received elsewhere, eg. by a Kopf handler,
+        unless a newer generation is already cached
+        """
+        name = body["metadata"]["name"]
+        cached = self.objects.get(name)
+        if not cached or cached["metadata"].get("generation", 0) <= body["metadata"].get("generation", 0):
+            self.objects[name] = freeze(body)
+
+    async def get(self, name, missing_ok=False):
+        """
+        Return class object, with missing_ok None if it does not exist
+        """
+        if not self._watcher or self._watcher.done():
+            self._watcher = spawn(self._watch())
+        try:
+            class_body = self.objects[name]
+        except KeyError:
+            self.misses += 1
+            try:
+                class_body = freeze(await api_request("GET", "%s/%s" % (self.path, name)))
+            except ApiException as e:
+                if e.status == 404 and missing_ok:
+                    return None
+                raise
+            self.objects.setdefault(name, class_body)
+        else:
+            self.hits += 1
+        return class_body
+
+
+def get_class_cache(plural, version="v1alpha1"):
+    """
+    Return shared cache for Cluster*Class objects
+    """
+    try:
+        return _class_caches[plural]
+    except KeyError:
+        cache = _class_caches[plural] = ClassCache(plural, version)
+        return cache
+
+
+def make_validator(class_cache, check=None):
+    """
+    Return admission handler rejecting objects referring to a nonexistent
+    class or failing the check shared with the creation handler, the check
+    is called with object and class spec and raises kopf.PermanentError.
+    Updates are checked only if they change the class, so that objects of
+    a class deleted or changed meanwhile can still be updated and deleted
+    """
+    async def validate(spec, operation, old=None, **kwargs):
+        if operation not in ("CREATE", "UPDATE"):
+            return
+        if operation == "UPDATE" and old and old.get("spec", {}).get("class") == spec.get("class"):
+            return
+        try:
+            class_body = await class_cache.get(spec["class"])
+        except ApiException as e:
+            if e.status == 404:
+                raise kopf.AdmissionError("Class %s does not exist" % repr(spec["class"]))
+            raise
+        if check:
+            try:
+                check(spec, class_body["spec"])
+            except kopf.PermanentError as e:
+                raise kopf.AdmissionError(str(e))
+    return validate
+
+
+def make_webhook_server(service, port=WEBHOOK_PORT):
+    """
+    Return webhook server reached via the named service, or None if the
+    webhook is disabled or replicas lack a shared certificate
+    """
+    if not port:
+        return None
+    if SHARDING and not (WEBHOOK_CERTFILE and WEBHOOK_PKEYFILE):
+        logging.warning("Not serving admission webhook from multiple replicas "
+            "without WEBHOOK_CERTFILE and WEBHOOK_PKEYFILE")
+        return None
+    return kopf.WebhookServer(
+        port=port,
+        host="%s.%s.svc" % (service, WEBHOOK_NAMESPACE),
+        cafile=WEBHOOK_CAFILE,
+        certfile=WEBHOOK_CERTFILE,
+        pkeyfile=WEBHOOK_PKEYFILE)
+
+
+def configure_webhook(settings, name):
+    """
+    Serve admission webhooks from the operator process, the validating
+    webhook configuration is maintained by Kopf. A server already set up
+    by the bundle is kept as operators sharing a process need own ports
+    """
+    if not settings.admission.server:
+        settings.admission.server = make_webhook_server(name)
+    if settings.admission.server:
+        settings.admission.managed = "%s.codemowers.io" % name
+
+
+def decode_secret(data):
+    """
+    Decode base64 encoded data of a Kubernetes secret
+    """
+    return FrozenDict((key, b64decode(value).decode("utf-8")) for key, value in (data or {}).items())
+
+
+assert decode_secret({"user": "cm9vdA=="}) == {"user": "root"}
+
+
+class CredentialCache(object):
+    """
+    Decoded contents of secrets, invalidated by a watch on each cached secret
+    """
+    def __init__(self):
+        self.secrets = {}
+        self.hits = 0
+        self.misses = 0
+        self._watchers = {}
+
+    async def _watch(self, namespace, name):
+        key = namespace, name
+        async for event_type, obj in watch_objects(
+                "/api/v1/namespaces/%s/secrets" % namespace,
+                fieldSelector="metadata.name=%s" % name):
+            if event_type == "LIST":
+                if obj:
+                    self.secrets[key] = decode_secret(obj[0].get("data"))
+                else:
+                    self.secrets.pop(key, None)
+            elif event_type == "DELETED":
+                self.secrets.pop(key, None)
+            elif event_type in ("ADDED", "MODIFIED"):
+                self.secrets[key] = decode_secret(obj.get("data"))
+
+    async def get(self, namespace, name):
+        key = namespace, name
+        watcher = self._watchers.get(key)
+        if not watcher or watcher.done():
+            self._watchers[key] = spawn(self._watch(namespace, name))
+        try:
+            credentials = self.secrets[key]
+        except KeyError:
+            self.misses += 1
+            secret = await api_request("GET", "/api/v1/namespaces/%s/secrets/%s" % (namespace, name))
+            credentials = self.secrets[key] = decode_secret(secret.get("data"))
+        else:
+            self.hits += 1
+        return credentials
+
+
+async def read_credentials(namespace, name, cached=True):
+    """
+    Return decoded contents of a secret holding cluster credentials,
+    use cached=False for secrets of dedicated clusters to avoid
+    setting up a watch per cluster
+    """
+    global _credential_cache
+    if not cached:
+        secret = await api_request("GET", "/api/v1/namespaces/%s/secrets/%s" % (namespace, name))
+        return decode_secret(secret.get("data"))
+    if not _credential_cache:
+        _credential_cache = CredentialCache()
+    return await _credential_cache.get(namespace, name)
+
+
+class ConnectionPools(object):
+    """
+    Bounded admin connection pools keyed by target cluster, pools which
+    have not been used for ADMIN_POOL_IDLE_TIMEOUT seconds are closed
+    """
+    def __init__(self, create_pool, ping):
+        self.create_pool = create_pool
+        self.ping = ping
+        self.pools = {}
+        self._lock = asyncio.Lock()
+        self._reaper = None
+        at_shutdown(self.close)
+
+    async def _close_pool(self, pool):
+        pool.close()
+        await pool.wait_closed()
+
+    async def _reap(self):
+        while True:
+            await asyncio.sleep(ADMIN_POOL_IDLE_TIMEOUT / 2)
+            deadline = asyncio.get_running_loop().time() - ADMIN_POOL_IDLE_TIMEOUT
+            for key, (kwargs, pool, last_used) in list(self.pools.items()):
+                if last_used < deadline and pool.freesize == pool.size:
+                    logging.info("Closing idle connection pool for %s" % repr(key))
+                    del self.pools[key]
+                    await self._close_pool(pool)
+
+    async def _get_pool(self, key, kwargs):
+        async with self._lock:
+            if not self._reaper or self._reaper.done():
+                self._reaper = spawn(self._reap())
+            try:
+                pool_kwargs, pool, _ = self.pools[key]
+            except KeyError:
+                pass
+            else:
+                if pool_kwargs == kwargs:
+                    return pool
+                # Credentials or endpoint changed
+                del self.pools[key]
+                await self._close_pool(pool)
+            logging.info("Opening connection pool for %s" % repr(key))
+            pool = await self.create_pool(minsize=0, maxsize=ADMIN_POOL_MAXSIZE, **kwargs)
+            self.pools[key] = kwargs, pool, asyncio.get_running_loop().time()
+            return pool
+
+    @contextlib.asynccontextmanager
+    async def acquire(self, key, **kwargs):
+        pool = await self._get_pool(key, kwargs)
+        self.pools[key] = kwargs, pool, asyncio.get_running_loop().time()
+        conn = await pool.acquire()
+        try:
+            try:
+                await self.ping(conn)
+            except Exception as e:
+                # Drop broken connection and try once more with a fresh one
+                logging.info("Discarding stale connection to %s: %s" % (repr(key), e))
+                closing = conn.close()
+                if inspect.isawaitable(closing):
+                    await closing
+                await pool.release(conn)
+                conn = None
+                conn = await pool.acquire()
+            yield conn
+        finally:
+            if conn is not None:
+                await pool.release(conn)
+
+    async def close(self):
+        for key, (_, pool, _) in list(self.pools.items()):
+            del self.pools[key]
+            await self._close_pool(pool)
+
+
+def get_cluster_semaphore(key, limit=None):
+    """
+    Return semaphore bounding simultaneous provisioning operations against
+    backend cluster identified by key, eg. (target_namespace, instance).
+    Semaphore is replaced if the limit of the class changes
+    """
+    limit = limit or CLUSTER_MAX_CONCURRENCY
+    try:
+        semaphore, current = _cluster_semaphores[key]
+    except KeyError:
+        current = None
+    if current != limit:
+        semaphore = asyncio.Semaphore(limit)
+        _cluster_semaphores[key] = semaphore, limit
+    return semaphore
+
+
+class Coalescer(object):
+    """
+    Collect requests for the same key arriving within PROVISIONING_WINDOW
+    seconds and hand them over to execute(key, items) as a single batch.
+    If the batch fails each item is retried on its own so that one
+    bad request does not fail the others
+    """
+    def __init__(self, execute):
+        self.execute = execute
+        self.pending = {}
+
+    async def submit(self, key, item):
+        future = asyncio.get_running_loop().create_future()
+        try:
+            batch = self.pending[key]
+        except KeyError:
+            batch = self.pending[key] = []
+            spawn(self._linger(key, batch))
+        batch.append((item, future))
+        if len(batch) >= PROVISIONING_BATCH_SIZE:
+            del self.pending[key]
+            spawn(self._flush(key, batch))
+        # Let more handlers join the batch instead of holding them back
+        async with released():
+            return await future
+
+    async def _linger(self, key, batch):
+        await asyncio.sleep(PROVISIONING_WINDOW)
+        if self.pending.get(key) is batch:
+            del self.pending[key]
+            await self._flush(key, batch)
+
+    async def _flush(self, key, batch):
+        try:
+            await self.execute(key, [item for item, _ in batch])
+        except Exception as e:
+            if len(batch) == 1:
+                results = [e]
+            else:
+                logging.info("Batch of %d for %s failed, retrying individually: %s" % (
+                    len(batch), repr(key), e))
+                results = []
+                for item, _ in batch:
+                    try:
+                        await self.execute(key, [item])
+                    except Exception as e:
+                        results.append(e)
+                    else:
+                        results.append(None)
+        else:
+            logging.info("Provisioned batch of %d for %s" % (len(batch), repr(key)))
+            results = [None] * len(batch)
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if result:
+                future.set_exception(result)
+            else:
+                future.set_result(None)
+
+
+class FairScheduler(object):
+    """
+    Admit handler invocations in weighted round-robin order between
+    namespaces, so that a burst of objects in one namespace does not
+    delay objects of other namespaces. At most limit invocations run
+    at once, at most namespace_limit of them for the same namespace
+    """
+    def __init__(self, limit, namespace_limit, weights):
+        self.limit = limit
+        self.namespace_limit = namespace_limit
+        self.weights = weights
+        self.queues = {}
+        self.ring = deque()
+        self.credits = {}
+        self.in_flight = 0
+        self.namespace_in_flight = Counter()
+
+    async def acquire(self, namespace):
+        future = asyncio.get_running_loop().create_future()
+        if namespace not in self.queues:
+            self.queues[namespace] = deque()
+            self.ring.append(namespace)
+        self.queues[namespace].append(future)
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Slot may have been granted just before cancellation
+            if future.done() and not future.cancelled():
+                self.release(namespace)
+            raise
+
+    def release(self, namespace):
+        self.in_flight -= 1
+        self.namespace_in_flight[namespace] -= 1
+        if not self.namespace_in_flight[namespace]:
+            del self.namespace_in_flight[namespace]
+        self._dispatch()
+
+    def _dispatch(self):
+        blocked = 0
+        while self.ring and self.in_flight < self.limit and blocked < len(self.ring):
+            namespace = self.ring[0]
+            queue = self.queues[namespace]
+            while queue and queue[0].cancelled():
+                queue.popleft()
+            if not queue:
+                self.ring.popleft()
+                del self.queues[namespace]
+                self.credits.pop(namespace, None)
+                continue
+            if self.namespace_in_flight[namespace] >= self.namespace_limit:
+                self.ring.rotate(-1)
+                blocked += 1
+                continue
+            blocked = 0
+            queue.popleft().set_result(None)
+            self.in_flight += 1
+            self.namespace_in_flight[namespace] += 1
+            # Namespace keeps its turn until it has used up its weight
+            credits = self.credits.get(namespace, self.weights.get(namespace, 1)) - 1
+            if credits > 0:
+                self.credits[namespace] = credits
+            else:
+                self.credits.pop(namespace, None)
+                self.ring.rotate(-1)
+
+
+def get_scheduler(name):
+    """
+    Return fair scheduler shared by handlers of the named operator,
+    operators sharing a process do not compete for the same slots
+    """
+    try:
+        return _schedulers[name]
+    except KeyError:
+        scheduler = _schedulers[name] = FairScheduler(
+            FAIR_MAX_IN_FLIGHT, FAIR_NAMESPACE_MAX_IN_FLIGHT, FAIR_WEIGHTS)
+        return scheduler
+
+
+class FairSlot(object):
+    """
+    Slot of a handler invocation in the fair scheduler which can be
+    handed over to others for a while, see released()
+    """
+    def __init__(self, scheduler, namespace):
+        self.scheduler = scheduler
+        self.namespace = namespace
+        self.held = False
+
+    async def acquire(self):
+        await self.scheduler.acquire(self.namespace)
+        self.held = True
+
+    def release(self):
+        if self.held:
+            self.held = False
+            self.scheduler.release(self.namespace)
+
+
+def fair(handler):
+    """
+    Decorator for Kopf handlers admitting invocations through the fair
+    scheduler of the operator by namespace of the object, to be placed
+    closest to the function so that the handler id stays the same.
+    Deletion handlers are better left out so that they never queue
+    behind creations
+    """
+    @functools.wraps(handler)
+    async def wrapped(*args, **kwargs):
+        slot = FairSlot(get_scheduler(handler.__module__), kwargs.get("namespace"))
+        await slot.acquire()
+        token = _fair_slot.set(slot)
+        try:
+            return await handler(*args, **kwargs)
+        finally:
+            _fair_slot.reset(token)
+            slot.release()
+    return wrapped
+
+
+@contextlib.asynccontextmanager
+async def released():
+    """
+    Hand the fair scheduling slot of the running handler over to other
+    handlers while waiting on something else than the handler itself,
+    such as a cluster coming up or a provisioning batch filling up
+    """
+    slot = _fair_slot.get()
+    if not slot or not slot.held:
+        yield
+        return
+    slot.release()
+    try:
+        yield
+    finally:
+        await slot.acquire()
+
+
+class ShardRing(object):
+    """
+    Split objects between operator replicas by rendezvous hashing of
+    namespace/name over live members of a peering object. Every replica
+    keeps Kopf state under its own annotation prefix, as replicas not
+    owning an object still record it as handled. Objects gained on
+    membership change are reconciled by the handler directly
+    """
+    DOMAIN = "shards.codemowers.io"
+
+    def __init__(self, name, plural, version="v1alpha1"):
+        self.name = name
+        self.plural = plural
+        self.version = version
+        self.path = "/apis/zalando.org/v1/clusterkopfpeerings/%s" % name
+        self.identity = (os.getenv("HOSTNAME") or "%s-%d" % (name, os.getpid())).lower()
+        self.prefix = "%s.%s" % (self.identity, self.DOMAIN)
+        self.members = (self.identity,)
+        self.stale = ()
+        self.handler = None
+
+    def owner(self, namespace, name, members=None):
+        key = ("%s/%s" % (namespace, name)).encode("utf-8")
+        return max(members or self.members, key=lambda member: hashlib.sha256(
+            member.encode("utf-8") + b"\0" + key).digest())
+
+    def owns(self, namespace, name, **_):
+        """
+        Filter for the when= argument of Kopf handlers
+        """
+        return self.owner(namespace, name) == self.identity
+
+    async def heartbeat(self, leaving=False):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        peers = dict((identity, None) for identity in self.stale)
+        peers[self.identity] = None if leaving else {
+            "priority": 0,
+            "lifetime": SHARD_LIFETIME,
+            "lastseen": now.isoformat(),
+        }
+        try:
+            body = await api_request("PATCH", self.path, {"status": peers},
+                content_type="application/merge-patch+json")
+        except ApiException as e:
+            if e.status != 404 or leaving:
+                raise
+            body = await api_request("POST", "/apis/zalando.org/v1/clusterkopfpeerings", {
+                "apiVersion": "zalando.org/v1",
+                "kind": "ClusterKopfPeering",
+                "metadata": {"name": self.name},
+                "status": peers,
+            })
+        members, stale = [], []
+        for identity, peer in (body.get("status") or {}).items():
+            age = now - datetime.datetime.fromisoformat(peer["lastseen"])
+            if age.total_seconds() < peer.get("lifetime", SHARD_LIFETIME):
+                members.append(identity)
+            else:
+                stale.append(identity)
+        self.stale = tuple(stale)
+        return tuple(sorted(members)) or (self.identity,)
+
+    async def start(self):
+        """
+        Join the ring before Kopf starts handling objects, existing members
+        are given a heartbeat to notice the new member
+        """
+        self.members = await self.heartbeat()
+        if self.members != (self.identity,):
+            await asyncio.sleep(SHARD_HEARTBEAT_INTERVAL)
+            self.members = await self.heartbeat()
+        logging.info("Joined %s as %s with %d members" % (self.name, self.identity, len(self.members)))
+        spawn(self.run())
+        at_shutdown(self.leave)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(SHARD_HEARTBEAT_INTERVAL)
+            try:
+                members = await self.heartbeat()
+            except Exception as e:
+                logging.warning("Heartbeat to %s failed: %s" % (self.name, e))
+                continue
+            if members == self.members:
+                continue
+            previous, self.members = self.members, members
+            logging.info("Members of %s changed from %d to %d" % (self.name, len(previous), len(members)))
+            try:
+                await self.rebalance(previous)
+            except Exception as e:
+                logging.warning("Rebalancing %s failed: %s" % (self.name, e))
+
+    def departed(self, meta):
+        """
+        Return Kopf annotations of replicas no longer in the ring
+        """
+        suffix = "." + self.DOMAIN
+        return [key for key in meta.get("annotations") or {}
+            if key.partition("/")[0].endswith(suffix)
+            and key.partition("/")[0][:-len(suffix)] not in self.members]
+
+    async def rebalance(self, previous):
+        """
+        Reconcile objects gained from other replicas, Kopf of this replica
+        has already recorded them as handled and would not run creation.
+        Kopf state left behind by departed replicas is dropped on the way
+        """
+        path = "/apis/codemowers.io/%s/%s" % (self.version, self.plural)
+        gained = []
+        for body in (await api_request("GET", path))["items"]:
+            namespace, name = body["metadata"]["namespace"], body["metadata"]["name"]
+            departed = self.departed(body["metadata"])
+            if departed:
+                try:
+                    await api_request("PATCH",
+                        "/apis/codemowers.io/%s/namespaces/%s/%s/%s" % (self.version, namespace, self.plural, name),
+                        {"metadata": {"annotations": dict((key, None) for key in departed)}},
+                        content_type="application/merge-patch+json")
+                except ApiException as e:
+                    if e.status != 404:
+                        logging.warning("Failed to clean up %s %s/%s: %s" % (self.plural, namespace, name, e))
+            if body["metadata"].get("deletionTimestamp"):
+                continue
+            if self.owns(namespace, name) and self.owner(namespace, name, previous) != self.identity:
+                gained.append((namespace, name))
+        logging.info("Taking over %d %s after rebalancing %s" % (len(gained), self.plural, self.name))
+        if gained and self.handler:
+            await roll_out(gained, self.plural, self.handler, self.version, force=True)
+
+    async def leave(self):
+        try:
+            await self.heartbeat(leaving=True)
+        except ApiException as e:
+            logging.warning("Failed to leave %s: %s" % (self.name, e))
+
+
+ring = ShardRing("test", "redises")
+ring.members = ("a", "b", "c")
+assert ring.owner("foo", "bar") == ring.owner("foo", "bar", ("c", "b", "a"))
+assert sum(ring.owner("foo", "bar%d" % j) == "a" for j in range(300)) in range(50, 150)
+assert ring.departed({"annotations": {
+    "a.shards.codemowers.io/last-handled-configuration": "{}",
+    "d.shards.codemowers.io/last-handled-configuration": "{}",
+    "kopf.zalando.org/last-handled-configuration": "{}"}}) == ["d.shards.codemowers.io/last-handled-configuration"]
+del ring
+
+
+def get_shard_ring(name, plural, version="v1alpha1"):
+    """
+    Return ring for objects of an operator, every object is owned by
+    this replica unless SHARDING is enabled
+    """
+    try:
+        return _shard_rings[name]
+    except KeyError:
+        ring = _shard_rings[name] = ShardRing(name, plural, version)
+        return ring
+
+
+async def open_shard_ring(settings, ring, handler):
+    """
+    Join the ring of operator replicas from the startup hook, Kopf peering
+    is disabled as all replicas are active and filter objects by ownership.
+    The creation handler is re-run for objects gained on rebalancing
+    """
+    if not SHARDING:
+        return
+    settings.peering.standalone = True
+    settings.persistence.diffbase_storage = kopf.AnnotationsDiffBaseStorage(prefix=ring.prefix)
+    settings.persistence.progress_storage = kopf.AnnotationsProgressStorage(prefix=ring.prefix)
+    ring.handler = handler
+    await ring.start()
+
+
+# Resource names of the kinds created by the operators, plurals
+# can not be derived reliably from kinds eg. Endpoints or NetworkPolicy
+KIND_PLURALS = {
+    "InnoDBCluster": "innodbclusters",
+    "PostgresCluster": "postgresclusters",
+    "Secret": "secrets",
+    "Service": "services",
+    "StatefulSet": "statefulsets",
+}
+
+
+def resource_path(body, name=None):
+    """
+    Derive API path of namespaced object from its manifest,
+    the kind has to be listed in KIND_PLURALS
+    """
+    api_version = body["apiVersion"]
+    prefix = ("/apis/%s" if "/" in api_version else "/api/%s") % api_version
+    plural = KIND_PLURALS[body["kind"]]
+    path = "%s/namespaces/%s/%s" % (prefix, body["metadata"]["namespace"], plural)
+    if name:
+        path += "/" + name
+    return path
+
+
+assert resource_path({
+    "apiVersion": "apps/v1",
+    "kind": "StatefulSet",
+    "metadata": {"namespace": "foo"}}, "bar") == "/apis/apps/v1/namespaces/foo/statefulsets/bar"
+assert resource_path({
+    "apiVersion": "v1",
+    "kind": "Service",
+    "metadata": {"namespace": "foo"}}) == "/api/v1/namespaces/foo/services"
+assert resource_path({
+    "apiVersion": "mysql.oracle.com/v2",
+    "kind": "InnoDBCluster",
+    "metadata": {"namespace": "foo"}}) == "/apis/mysql.oracle.com/v2/namespaces/foo/innodbclusters"
+
+
+def json_dumps(obj):
+    """
+    Serialize request body, uses orjson if available
+    """
+    if orjson:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+
+json_loads = orjson.loads if orjson else json.loads
+
+assert json_loads(json_dumps({"data": {"a": "b"}, "items": ("c",)})) == {"data": {"a": "b"}, "items": ["c"]}
+
+
+class RateLimiter(object):
+    """
+    Token bucket refilled at qps tokens per second up to burst tokens.
+    Requests that can't be served right away wait in priority order,
+    time spent waiting is accounted for reporting
+    """
+    def __init__(self, name, qps, burst):
+        self.name = name
+        self.qps = qps
+        self.burst = burst
+        self.tokens = burst
+        self.updated = None
+        self.waiters = []
+        self.requests = 0
+        self.throttled = 0
+        self.waited = 0.0
+        self.max_waited = 0.0
+        self._sequence = itertools.count()
+        self._timer = None
+
+    def _refill(self):
+        now = asyncio.get_running_loop().time()
+        if self.updated is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.qps)
+        self.updated = now
+
+    def _schedule(self):
+        if self._timer or not self.waiters:
+            return
+        self._timer = asyncio.get_running_loop().call_later(
+            max(0, (1 - self.tokens) / self.qps), self._drain)
+
+    def _drain(self):
+        self._timer = None
+        self._refill()
+        while self.waiters and self.tokens >= 1:
+            _, _, future = heapq.heappop(self.waiters)
+            if future.cancelled():
+                continue
+            self.tokens -= 1
+            future.set_result(None)
+        self._schedule()
+
+    async def acquire(self, priority=PRIORITY_NORMAL):
+        self.requests += 1
+        self._refill()
+        if not self.waiters and self.tokens >= 1:
+            self.tokens -= 1
+            return
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        heapq.heappush(self.waiters, (priority, next(self._sequence), future))
+        self._schedule()
+        started = loop.time()
+        try:
+            await future
+        finally:
+            waited = loop.time() - started
+            self.throttled += 1
+            self.waited += waited
+            self.max_waited = max(self.max_waited, waited)
+
+    def stats(self):
+        return "Rate limiter %s: %d requests, %d throttled, %.1fs waited in total, %.2fs at most" % (
+            self.name, self.requests, self.throttled, self.waited, self.max_waited)
+
+
+def get_rate_limiter(method):
+    """
+    Return token bucket for reads or writes depending on the HTTP method
+    """
+    name = "read" if method == "GET" else "write"
+    try:
+        return _rate_limiters[name]
+    except KeyError:
+        if name == "read":
+            limiter = RateLimiter(name, KUBE_READ_QPS, KUBE_READ_BURST)
+        else:
+            limiter = RateLimiter(name, KUBE_WRITE_QPS, KUBE_WRITE_BURST)
+        _rate_limiters[name] = limiter
+        return limiter
+
+
+def request_priority(method, path, body=None):
+    """
+    Deletes and status updates go ahead of bulk creates and applies
+    """
+    if method == "DELETE" or path.endswith("/status") or (method == "PATCH" and body and set(body) == {"status"}):
+        return PRIORITY_URGENT
+    if method in ("POST", "PUT", "PATCH"):
+        return PRIORITY_BULK
+    return PRIORITY_NORMAL
+
+
+assert request_priority("DELETE", "/api/v1/namespaces/foo/secrets/bar") == PRIORITY_URGENT
+assert request_priority("PATCH", "/apis/codemowers.io/v1alpha1/namespaces/foo/redises/bar", {"status": {}}) == PRIORITY_URGENT
+assert request_priority("POST", "/api/v1/namespaces/foo/secrets", {"metadata": {}}) == PRIORITY_BULK
+assert request_priority("GET", "/api/v1/namespaces/foo/secrets") == PRIORITY_NORMAL
+
+
+async def _report_rate_limits():
+    reported = {}
+    while True:
+        await asyncio.sleep(60)
+        for name, limiter in _rate_limiters.items():
+            if limiter.throttled != reported.get(name):
+                reported[name] = limiter.throttled
+                logging.info(limiter.stats())
+
+
+@contextlib.asynccontextmanager
+async def api_stream(method, path, body=None, query_params=None, content_type="application/json", timeout=REQUEST_TIMEOUT):
+    """
+    Issue request against the API server bypassing the OpenAPI models
+    and the serialization of kubernetes_asyncio, yields aiohttp response.
+    Requests are subject to client-side rate limits
+    """
+    api_client = get_api_client()
+    await get_rate_limiter(method).acquire(request_priority(method, path, body))
+    headers = {"Accept": "application/json", "Content-Type": content_type}
+    query_params = list(query_params or [])
+    await api_client.update_params_for_auth(headers, query_params, ["BearerToken"])
+    url = api_client.configuration.host + path
+    if query_params:
+        url += "?" + urlencode(query_params)
+    async with api_client.rest_client.pool_manager.request(
+            method, url,
+            headers=headers,
+            data=None if body is None else json_dumps(body),
+            timeout=timeout) as response:
+        if not 200 <= response.status <= 299:
+            raise ApiException(http_resp=RESTResponse(response, await response.read()))
+        yield response
+
+
+async def api_request(method, path, body=None, query_params=None, content_type="application/json"):
+    """
+    Issue request against the API server, returns the decoded JSON response
+    """
+    async with api_stream(method, path, body, query_params, content_type) as response:
+        return json_loads(await response.read())
+
+
+async def delete_resource(path):
+    """
+    Delete Kubernetes object, dependents are removed in the background,
+    returns False if it was already gone
+    """
+    try:
+        await api_request("DELETE", path, query_params=[("propagationPolicy", "Background")])
+    except ApiException as e:
+        if e.status == 404:
+            return False
+        raise
+    return True
+
+
+async def tear_down(paths, owned=False):
+    """
+    Delete objects concurrently, objects already gone count as deleted so
+    interrupted teardowns can be retried. Objects owned by the custom
+    resource being deleted are left to the garbage collector
+    """
+    if owned and TEARDOWN_VIA_OWNER_REFERENCES:
+        return
+    results = await asyncio.gather(*[delete_resource(path) for path in paths], return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+
+
+async def create_resource(body):
+    """
+    Create Kubernetes object described by the manifest, returns the created
+    object or None if the object already exists
+    """
+    try:
+        created = await api_request("POST", resource_path(body), body)
+    except ApiException as e:
+        if e.status == 409:
+            logging.info("%s %s/%s already exists" % (
+                body["kind"], body["metadata"]["namespace"], body["metadata"]["name"]))
+            return None
+        raise
+    logging.info("Created %s %s/%s" % (
+        body["kind"], body["metadata"]["namespace"], body["metadata"]["name"]))
+    return created
+
+
+async def ensure_resource(body):
+    """
+    Create Kubernetes object unless it already exists, returns the object
+    as stored in the cluster. Existing objects are never overwritten which
+    makes this suitable for generated credentials
+    """
+    path = resource_path(body)
+    name = body["metadata"]["name"]
+    if SERVER_SIDE_APPLY:
+        # In apply mode the object most likely exists already on resume
+        try:
+            return await api_request("GET", "%s/%s" % (path, name))
+        except ApiException as e:
+            if e.status != 404:
+                raise
+    existing = await create_resource(body)
+    if existing:
+        return existing
+    return await api_request("GET", "%s/%s" % (path, name))
+
+
+async def apply_resource(body, field_manager):
+    """
+    Create or update Kubernetes object with server-side apply,
+    returns the resulting object
+    """
+    applied = await api_request(
+        "PATCH",
+        resource_path(body, body["metadata"]["name"]),
+        body,
+        query_params=[("fieldManager", field_manager), ("force", "true")],
+        content_type="application/apply-patch+yaml")
+    logging.info("Applied %s %s/%s" % (
+        body["kind"], body["metadata"]["namespace"], body["metadata"]["name"]))
+    return applied
+
+
+class ResourceGraph(object):
+    """
+    Kubernetes objects with dependencies between them,
+    independent objects are created concurrently.
+
+    With SERVER_SIDE_APPLY enabled objects are converged using the
+    field manager of the operator, generated objects such as secrets
+    with random passwords are only created if missing.
+    Resulting objects are stored in results, None means the object
+    already existed and was not read back
+    """
+    def __init__(self, field_manager):
+        self.field_manager = field_manager
+        self.nodes = {}
+        self.timings = {}
+        self.results = {}
+
+    def add(self, name, body, depends=(), generated=False):
+        for dependency in depends:
+            if dependency not in self.nodes:
+                raise ValueError("Unknown dependency %s for %s" % (dependency, name))
+        self.nodes[name] = body, depends, generated
+
+    async def _apply_node(self, name, tasks):
+        body, depends, generated = self.nodes[name]
+        await asyncio.gather(*[tasks[dependency] for dependency in depends])
+        started = asyncio.get_running_loop().time()
+        if not SERVER_SIDE_APPLY:
+            self.results[name] = await create_resource(body)
+        elif generated:
+            self.results[name] = await ensure_resource(body)
+        else:
+            self.results[name] = await apply_resource(body, self.field_manager)
+        self.timings[name] = asyncio.get_running_loop().time() - started
+
+    async def apply(self):
+        tasks = {}
+        for name in self.nodes:
+            tasks[name] = asyncio.ensure_future(self._apply_node(name, tasks))
+        try:
+            await asyncio.gather(*tasks.values())
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            raise
+        finally:
+            logging.info("Applied %s" % ", ".join(
+                "%s in %.3fs" % (name, timing) for name, timing in self.timings.items()))
 
 
 def make_resolver(plural, version, fmt="%s"):
-    async def wrapped(namespace, name, body):
-        api_client = client.ApiClient()
-        api_instance = client.CustomObjectsApi(api_client)
+    class_cache = get_class_cache(plural, version)
 
-        class_body = await api_instance.get_cluster_custom_object(
-            "codemowers.io",
-            version,
-            plural,
-            body["spec"]["class"])
+    async def wrapped(namespace, name, body):
+        class_body = await class_cache.get(body["spec"]["class"])
 
         target_namespace = class_body["spec"].get("targetNamespace", namespace)
         instance = class_body["spec"].get("targetCluster", name)
@@ -118,5 +1632,321 @@ def make_resolver(plural, version, fmt="%s"):
 
         # Derive owner object for Kopf
         owner = body if target_namespace == namespace else class_body
-        return target_namespace, fmt % instance, owner, api_client, api_instance, class_body["spec"]
+        return target_namespace, fmt % instance, owner, class_body["spec"]
     return wrapped
+
+
+def make_fingerprint(filename):
+    """
+    Return function computing digest of handler inputs, the source of
+    the operator and this module is mixed in so that changes to rendered
+    manifests invalidate fingerprints stored by previous versions, so are
+    settings changing how the manifests are applied
+    """
+    source = hashlib.sha256()
+    for path in (__file__, filename):
+        with open(path, "rb") as fh:
+            source.update(fh.read())
+    source.update(json.dumps({
+        "serverSideApply": SERVER_SIDE_APPLY,
+    }).encode("utf-8"))
+
+    def fingerprint(*inputs):
+        digest = source.copy()
+        digest.update(json.dumps(inputs, sort_keys=True).encode("utf-8"))
+        return digest.hexdigest()[:32]
+    return fingerprint
+
+
+fingerprint = make_fingerprint(__file__)
+assert fingerprint({"a": 1, "b": (2,)}) == fingerprint(freeze({"b": [2], "a": 1}))
+assert fingerprint({"a": 1}) != fingerprint({"a": 2})
+del fingerprint
+
+
+async def is_unchanged(status, digest, path, handler="creation"):
+    """
+    Check whether handler has already completed with the same fingerprint,
+    only the existence of the final object at path is verified
+    """
+    if (status.get(handler) or {}).get("fingerprint") != digest:
+        return False
+    try:
+        await api_request("GET", path)
+    except ApiException as e:
+        if e.status == 404:
+            return False
+        raise
+    return True
+
+
+def matches(expected, actual):
+    """
+    Check whether fields present in expected have the same values in actual
+    """
+    if isinstance(expected, Mapping):
+        return isinstance(actual, Mapping) and all(
+            matches(value, actual.get(key)) for key, value in expected.items())
+    return expected == actual
+
+
+assert matches({"spec": {"replicas": 3}}, {"spec": {"replicas": 3, "template": {}}})
+assert not matches({"spec": {"replicas": 3}}, {"spec": {"replicas": 1}})
+assert not matches({"spec": {"replicas": 3}}, {})
+
+
+class Sweeper(object):
+    """
+    Periodically compare objects expected for custom resources against ones
+    present and re-run the creation handler for custom resources with
+    missing or drifted objects. Every kind is listed once per sweep by the
+    labels of the application, objects predating the labels are adopted.
+    The expected coroutine function returns a dict of expected objects for
+    a custom resource, keyed by (plural, namespace, name) with the fields
+    checked for drift as value. Drift is corrected only with
+    SERVER_SIDE_APPLY as objects are otherwise never updated. Objects
+    marked GENERATED hold generated credentials, recreating them would
+    hand out credentials nothing is using, so their custom resources are
+    only reported as missing them
+    """
+    KINDS = {
+        "secrets": "/api/v1",
+        "services": "/api/v1",
+        "statefulsets": "/apis/apps/v1",
+    }
+    GENERATED = "generated"
+
+    def __init__(self, plural, handler, expected, labels, owns=None, version="v1alpha1"):
+        self.plural = plural
+        self.handler = handler
+        self.expected = expected
+        self.labels = labels
+        self.owns = owns
+        self.version = version
+
+    async def sweep(self):
+        expected = {}
+        async for body in list_objects("/apis/codemowers.io/%s/%s" % (self.version, self.plural)):
+            meta = body["metadata"]
+            if meta.get("deletionTimestamp") or not (body.get("status") or {}).get("creation"):
+                continue
+            if self.owns and not self.owns(meta["namespace"], meta["name"]):
+                continue
+            for key, fields in (await self.expected(meta["namespace"], meta["name"], body)).items():
+                expected[key] = (meta["namespace"], meta["name"]), fields
+
+        present = {}
+        selector = ",".join("%s=%s" % (key, value) for key, value in self.labels.items())
+        for plural in set(key[0] for key in expected):
+            async for obj in list_objects("%s/%s" % (self.KINDS[plural], plural), labelSelector=selector):
+                present[plural, obj["metadata"]["namespace"], obj["metadata"]["name"]] = obj
+
+        dependents, stranded = set(), set()
+        for key, (dependent, fields) in expected.items():
+            if key in present:
+                if fields and fields != self.GENERATED and not matches(fields, present[key]):
+                    if SERVER_SIDE_APPLY:
+                        dependents.add(dependent)
+                    else:
+                        logging.warning("%s %s/%s has drifted" % key)
+            elif not await self.adopt(*key):
+                if fields == self.GENERATED:
+                    logging.warning("%s %s/%s with generated credentials is missing" % key)
+                    stranded.add(dependent)
+                else:
+                    logging.info("%s %s/%s is missing" % key)
+                    dependents.add(dependent)
+
+        # Creation would generate new credentials for the ones in use
+        for namespace, name in stranded & dependents:
+            logging.warning("Not reconciling %s %s/%s, restore its credentials first" % (self.plural, namespace, name))
+        dependents -= stranded
+        if dependents:
+            logging.info("Reconciling %d %s with missing or drifted objects" % (len(dependents), self.plural))
+            await roll_out(dependents, self.plural, self.handler, self.version, force=True)
+
+    async def adopt(self, plural, namespace, name):
+        """
+        Label object created before the labels were introduced,
+        returns False if the object does not exist
+        """
+        try:
+            await api_request("PATCH", "%s/namespaces/%s/%s/%s" % (self.KINDS[plural], namespace, plural, name),
+                {"metadata": {"labels": self.labels}},
+                content_type="application/merge-patch+json")
+        except ApiException as e:
+            if e.status == 404:
+                return False
+            raise
+        return True
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(SWEEP_INTERVAL)
+            try:
+                await self.sweep()
+            except Exception as e:
+                logging.warning("Sweep of %s failed: %s" % (self.plural, e))
+
+
+class Reclaimer(object):
+    """
+    Periodically enumerate catalogs of the shared clusters and drop the
+    databases, users and buckets named after custom resources which no
+    longer exist. The enumerate coroutine function is called with a class
+    spec and returns the names found on the shared cluster of the class,
+    or None if the class has no shared cluster, drop is called with the
+    class spec and an orphaned name. Only a single replica reclaims
+    """
+    def __init__(self, plural, class_plural, naming, enumerate, drop, owns=None, version="v1alpha1"):
+        self.plural = plural
+        self.class_plural = class_plural
+        self.naming = naming
+        self.enumerate = enumerate
+        self.drop = drop
+        self.owns = owns
+        self.version = version
+        self.first_seen = {}
+        self.dropped = 0
+
+    async def reclaim(self):
+        live = set()
+        async for body in list_objects("/apis/codemowers.io/%s/%s" % (self.version, self.plural)):
+            live.add(self.naming(body["metadata"]["namespace"], body["metadata"]["name"]))
+
+        # Orphans not seen anymore start the grace period over
+        now = time.monotonic()
+        first_seen = {}
+        async for class_body in list_objects("/apis/codemowers.io/%s/%s" % (self.version, self.class_plural)):
+            class_name = class_body["metadata"]["name"]
+            try:
+                names = await self.enumerate(class_body["spec"])
+            except Exception as e:
+                logging.warning("Failed to enumerate cluster of %s %s: %s" % (self.class_plural, class_name, e))
+                continue
+            for name in set(names or ()) - live:
+                key = class_name, name
+                first_seen[key] = self.first_seen.get(key, now)
+                if now - first_seen[key] < RECLAIM_GRACE_PERIOD:
+                    continue
+                if RECLAIM_DRY_RUN:
+                    logging.info("Would reclaim %s orphaned by %s on cluster of %s" % (name, self.plural, class_name))
+                    continue
+                logging.info("Reclaiming %s orphaned by %s on cluster of %s" % (name, self.plural, class_name))
+                try:
+                    await self.drop(class_body["spec"], name)
+                except Exception as e:
+                    logging.warning("Failed to reclaim %s: %s" % (name, e))
+                else:
+                    self.dropped += 1
+                    del first_seen[key]
+        self.first_seen = first_seen
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(RECLAIM_INTERVAL)
+            if self.owns and not self.owns("", self.plural):
+                continue
+            try:
+                await self.reclaim()
+            except Exception as e:
+                logging.warning("Reclaiming %s failed: %s" % (self.plural, e))
+            logging.info("Reclaimed %d orphans of %s so far, %d pending" % (
+                self.dropped, self.plural, len(self.first_seen)))
+
+
+class PhaseTimer(object):
+    """
+    Measure duration of consecutive provisioning phases and render them
+    as status conditions to be written in the final status patch,
+    each mark closes the phase that started with the previous mark
+    """
+    def __init__(self):
+        self.started = self.last = time.monotonic()
+        self.phases = []
+
+    def mark(self, name):
+        now = time.monotonic()
+        self.phases.append((name, now - self.last))
+        self.last = now
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def conditions(self):
+        now = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        conditions = [{
+            "type": name,
+            "status": "True",
+            "reason": "Completed",
+            "message": "Completed in %.3fs" % duration,
+            "lastTransitionTime": now,
+        } for name, duration in self.phases]
+        conditions.append({
+            "type": "Ready",
+            "status": "True",
+            "reason": "Provisioned",
+            "message": "Provisioned in %.3fs" % self.elapsed,
+            "lastTransitionTime": now,
+        })
+        return conditions
+
+
+timer = PhaseTimer()
+timer.mark("ClassResolved")
+assert [c["type"] for c in timer.conditions()] == ["ClassResolved", "Ready"]
+del timer
+
+
+async def roll_out(dependents, plural, handler, version="v1alpha1", force=False):
+    """
+    Re-run creation handler for (namespace, name) pairs of objects
+    referring to a changed class and store results in their status
+    the same way Kopf does. Failed objects are retried via Kopf
+    retrying the class handler, completed ones are skipped by fingerprint
+    unless forced
+    """
+    if not SERVER_SIDE_APPLY and not force:
+        # Creating objects which already exist would change nothing
+        # while the stored fingerprint would make resume skip them
+        logging.warning("Not rolling out class change to %d %s, existing objects "
+            "are updated only with SERVER_SIDE_APPLY enabled" % (len(dependents), plural))
+        return
+    semaphore = asyncio.Semaphore(CLASS_ROLLOUT_CONCURRENCY)
+
+    async def reconcile(namespace, name):
+        path = "/apis/codemowers.io/%s/namespaces/%s/%s/%s" % (version, namespace, plural, name)
+        async with semaphore:
+            try:
+                body = await api_request("GET", path)
+            except ApiException as e:
+                if e.status == 404:
+                    return
+                raise
+            if body["metadata"].get("deletionTimestamp"):
+                return
+            patch = kopf.Patch()
+            result = await handler(
+                name=name,
+                namespace=namespace,
+                body=body,
+                spec=body["spec"],
+                meta=body["metadata"],
+                status={} if force else body.get("status") or {},
+                patch=patch)
+            if result:
+                patch.status["creation"] = result
+                await api_request("PATCH", path, dict(patch),
+                    content_type="application/merge-patch+json")
+
+    dependents = sorted(set(dependents))
+    results = await asyncio.gather(*[reconcile(*dependent) for dependent in dependents], return_exceptions=True)
+    failed = 0
+    for (namespace, name), result in zip(dependents, results):
+        if isinstance(result, Exception):
+            failed += 1
+            logging.warning("Failed to reconcile %s %s/%s: %s" % (plural, namespace, name, result))
+    logging.info("Rolled out class change to %d %s, %d failed" % (len(dependents), plural, failed))
+    if failed:
+        raise kopf.TemporaryError("%d of %d %s failed to reconcile" % (failed, len(dependents), plural), delay=30)
@@ -1,22 +1,113 @@
 #!/usr/bin/env python3
 import aiomysql
 import asyncio
+import functools
 import kopf
 import logging
 import os
-from base64 import b64decode
-from kubernetes_asyncio.client.exceptions import ApiException
-from kubernetes_asyncio import client, config
-from lib import Secret, make_selector, make_resolver
+from kubernetes_asyncio import config
+from lib import Coalescer, ConnectionPools, PhaseTimer, Reclaimer, ResourceGraph, Secret, configure_webhook, decode_secret, ensure_resource, fair, get_class_cache, get_cluster_semaphore, get_shard_ring, make_resolver, make_selector, make_validator, open_api_client, open_event_sink, open_shard_ring, read_credentials, shutdown, spawn, tear_down, wait_for_object
 
+FIELD_MANAGER = "mysql-operator"
+
+class_cache = get_class_cache("clustermysqldatabaseclasses")
 resolve_instance = make_resolver("clustermysqldatabaseclasses", "v1alpha1", "mysql-cluster-%s")
+shards = get_shard_ring("mysql-database-operator", "mysqldatabases")
+
+kopf.on.validate("mysqldatabases.codemowers.io", id="class", operations=["CREATE", "UPDATE"], ignore_failures=True)(
+    make_validator(class_cache))
+
+
+async def ping(conn):
+    await conn.ping(reconnect=False)
+
+
+pools = ConnectionPools(functools.partial(aiomysql.create_pool, autocommit=True), ping)
+
+
+async def provision(key, items):
+    """
+    Create databases and users for a batch of requests in one session
+    with a single privilege flush at the end, passwords of existing users
+    are reset to the published ones
+    """
+    async with get_cluster_semaphore(key, items[0]["limit"]), pools.acquire(key, **items[0]["connect"]) as conn:
+        async with conn.cursor() as cur:
+            for item in items:
+                await cur.execute("CREATE DATABASE IF NOT EXISTS `%s`" % item["database"])
+            identified = ", ".join([
+                "%s@'%%' IDENTIFIED WITH mysql_native_password BY %s" % (
+                    repr(item["user"]), repr(item["password"])) for item in items])
+            await cur.execute("CREATE USER IF NOT EXISTS " + identified)
+            await cur.execute("ALTER USER " + identified)
+            for item in items:
+                await cur.execute("GRANT ALL ON `%s`.* TO %s@'%%'" % (
+                    item["database"], repr(item["user"])))
+            await cur.execute("FLUSH PRIVILEGES")
+
+
+provisioner = Coalescer(provision)
+
+
+def qualified_name(namespace, name):
+    """
+    Database and user name for the MysqlDatabase
+    """
+    return ("%s_%s" % (namespace, name)).replace("-", "_")
+
+
+async def shared_cluster(class_spec):
+    """
+    Return pool key and connection parameters for the cluster shared
+    by objects of the class
+    """
+    target_namespace, instance = class_spec["targetNamespace"], "mysql-cluster-%s" % class_spec["targetCluster"]
+    cluster_secrets = await read_credentials(target_namespace, "%s-secrets" % instance, True)
+    return (target_namespace, instance), {
+        "host": "%s-primary.%s.svc.cluster.local" % (instance, target_namespace),
+        "user": cluster_secrets["rootUser"],
+        "password": cluster_secrets["rootPassword"],
+        "port": 3306,
+    }
+
 
+async def enumerate_catalog(class_spec):
+    """
+    List schemas having a user of the same name on the shared cluster
+    """
+    if "targetNamespace" not in class_spec or "targetCluster" not in class_spec:
+        return None
+    key, connect = await shared_cluster(class_spec)
+    async with pools.acquire(key, **connect) as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("SELECT SCHEMA_NAME FROM information_schema.SCHEMATA "
+                "WHERE SCHEMA_NAME IN (SELECT User FROM mysql.user)")
+            return [name for name, in await cur.fetchall() if "_" in name]
 
-@kopf.on.create("mysqldatabases.codemowers.io")
-async def creation(name, namespace, body, **kwargs):
-    target_namespace, instance, owner, api_client, api_instance, class_spec = await resolve_instance(
+
+async def drop_orphan(class_spec, name):
+    key, connect = await shared_cluster(class_spec)
+    async with get_cluster_semaphore(key, class_spec.get("maxConcurrency")), pools.acquire(key, **connect) as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("DROP DATABASE IF EXISTS `%s`" % name)
+            await cur.execute("DROP USER IF EXISTS %s" % repr(name))
+            await cur.execute("FLUSH PRIVILEGES")
+
+
+def cluster_online(obj):
+    """
+    InnoDB cluster accepts connections once primary is up
+    """
+    return obj.get("status", {}).get("cluster", {}).get("status") in ("ONLINE", "ONLINE_PARTIAL")
+
+
+@kopf.on.create("mysqldatabases.codemowers.io", when=shards.owns)
+@fair
+async def creation(name, namespace, body, patch, **kwargs):
+    timer = PhaseTimer()
+    target_namespace, instance, owner, class_spec = await resolve_instance(
         namespace, name, body)
-    v1 = client.CoreV1Api(api_client)
+    timer.mark("ClassResolved")
 
     capacity = body["spec"]["capacity"]
     replicas = class_spec["replicas"]
@@ -29,7 +120,7 @@ async def creation(name, namespace, body, **kwargs):
     if storage_class:
 
         # Create cluster secrets
-        body = sec.wrap([{
+        body = await sec.wrap([{
             "key": "rootHost",
             "value": "%%"
         }, {
@@ -41,15 +132,8 @@ async def creation(name, namespace, body, **kwargs):
         }])
 
         kopf.append_owner_reference(body, owner, block_owner_deletion=False)
-        try:
-            await v1.create_namespaced_secret(target_namespace, client.V1Secret(**body))
-        except ApiException as e:
-            if e.status == 409:
-                logging.info("Secret %s/%s already generated" % (target_namespace, sec.name))
-            else:
-                raise
-        else:
-            logging.info("Created secret %s/%s" % (target_namespace, sec.name))
+        graph = ResourceGraph(FIELD_MANAGER)
+        graph.add("secret", body, generated=True)
 
         _, replica_label_selector = make_selector("mysql-innodbcluster-mysql-server", "mysql-innodbcluster-%s-mysql-server" % instance)
         _, router_label_selector = make_selector("mysql-router", "mysql-innodbcluster-%s-router" % instance)
@@ -102,45 +186,32 @@ async def creation(name, namespace, body, **kwargs):
         }
 
         kopf.append_owner_reference(body, owner, block_owner_deletion=False)
-        try:
-            await api_instance.create_namespaced_custom_object(
-                "mysql.oracle.com",
-                "v2",
-                target_namespace,
-                "innodbclusters",
-                body)
-        except ApiException as e:
-            if e.status == 409:
-                logging.info("Mysql cluster %s/%s already generated" % (
-                    target_namespace, instance))
-            else:
-                raise
-        else:
-            logging.info("Created Mysql cluster %s/%s" % (
-                target_namespace, instance))
+        graph.add("innodbcluster", body, depends=("secret",))
+        await graph.apply()
+        timer.mark("ClusterApplied")
+
+        # Continue as soon as the cluster is up instead of failing until retried
+        await wait_for_object(
+            "/apis/mysql.oracle.com/v2/namespaces/%s/innodbclusters" % target_namespace,
+            instance,
+            cluster_online)
+        timer.mark("ClusterReady")
 
     # Fetch secrets to create bucket
-    cluster_secrets = await v1.read_namespaced_secret(
+    cluster_secrets = await read_credentials(
+        target_namespace,
         "%s-secrets" % instance,
-        target_namespace)
+        "targetCluster" in class_spec)
     cluster_hostname = "%s.%s.svc.cluster.local" % (instance, target_namespace)
     cluster_primary = "%s-primary.%s.svc.cluster.local" % (instance, target_namespace)
     cluster_port = 3306
 
-    conn = await aiomysql.connect(
-        host=cluster_primary,
-        user=b64decode(cluster_secrets.data["rootUser"]).decode("ascii"),
-        password=b64decode(cluster_secrets.data["rootPassword"]).decode("ascii"),
-        port=cluster_port)
-    cur = await conn.cursor()
-
     # Create database
-    user_name = database_name = ("%s_%s" % (namespace, name)).replace("-", "_")
-    await cur.execute("CREATE DATABASE IF NOT EXISTS `%s`" % database_name)
+    user_name = database_name = qualified_name(namespace, name)
 
     # Create secret for accessing bucket
     database_secrets = Secret(namespace, "mysql-database-%s-owner-secrets" % name)
-    body = database_secrets.wrap([{
+    body = await database_secrets.wrap([{
         "key": "MYSQL_HOST",
         "value": cluster_hostname,
     }, {
@@ -163,60 +234,73 @@ async def creation(name, namespace, body, **kwargs):
         "value": "mysql://%s:%%(plaintext)s@%s:%d/%s" % (
             user_name, cluster_hostname, cluster_port, database_name)
     }])
-
-    await cur.execute("CREATE USER IF NOT EXISTS %s@'%%' IDENTIFIED WITH mysql_native_password BY %s" % (
-        repr(user_name), repr(database_secrets["plaintext"])))
+    timer.mark("SecretGenerated")
 
     kopf.append_owner_reference(body, owner, block_owner_deletion=False)
-    try:
-        await v1.create_namespaced_secret(namespace, client.V1Secret(**body))
-    except ApiException as e:
-        if e.status == 409:
-            logging.info("Secret %s/%s already generated" % (namespace, database_secrets.name))
-        else:
-            raise
-    else:
-        logging.info("Created secret %s/%s" % (namespace, database_secrets.name))
 
-    await cur.execute("GRANT ALL ON `%s`.* TO %s@'%%'" % (
-        database_name, repr(user_name)))
-    await cur.execute("FLUSH PRIVILEGES")
+    # Use the stored secret in case last run was interrupted
+    secrets = decode_secret((await ensure_resource(body))["data"])
+    timer.mark("CredentialsPublished")
 
-    return {"state": "READY"}
+    await provisioner.submit((target_namespace, instance), {
+        "connect": {
+            "host": cluster_primary,
+            "user": cluster_secrets["rootUser"],
+            "password": cluster_secrets["rootPassword"],
+            "port": cluster_port,
+        },
+        "database": database_name,
+        "user": user_name,
+        "password": secrets["MYSQL_PASSWORD"],
+        "limit": class_spec.get("maxConcurrency"),
+    })
+    timer.mark("DatabaseCreated")
+
+    patch.status["conditions"] = timer.conditions()
+    return {"state": "READY", "latency": round(timer.elapsed, 3)}
 
 
 @kopf.on.delete("mysqldatabases.codemowers.io")
 async def deletion(name, namespace, body, **kwargs):
-    target_namespace, instance, _, api_client, api_instance, _ = await resolve_instance(
+    owner_secret = "/api/v1/namespaces/%s/secrets/mysql-database-%s-owner-secrets" % (namespace, name)
+    if not await class_cache.get(body["spec"]["class"], missing_ok=True):
+        # Nothing else can be located without the class, objects owned
+        # by this one or the class are left to the garbage collector
+        await tear_down([owner_secret])
+        return
+    target_namespace, instance, _, class_spec = await resolve_instance(
         namespace, name, body)
-    v1 = client.CoreV1Api(api_client)
-    try:
-        await v1.delete_namespaced_secret("mysql-database-%s-owner-secrets" % name, namespace)
-    except ApiException as e:
-        if e.status == 404:
-            pass
-        else:
-            raise
+
+    # Dedicated cluster goes away as a whole, no need to drop the database
+    if "targetCluster" not in class_spec and class_spec.get("storageClass"):
+        await tear_down([
+            owner_secret,
+            "/apis/mysql.oracle.com/v2/namespaces/%s/innodbclusters/%s" % (target_namespace, instance),
+            "/api/v1/namespaces/%s/secrets/%s-secrets" % (target_namespace, instance),
+        ], target_namespace == namespace)
+        return
+    await tear_down([owner_secret], target_namespace == namespace)
 
     # Fetch secrets to delete the database
-    cluster_secrets = await v1.read_namespaced_secret(
+    cluster_secrets = await read_credentials(
+        target_namespace,
         "%s-secrets" % instance,
-        target_namespace)
+        "targetCluster" in class_spec)
     cluster_primary = "%s-primary.%s.svc.cluster.local" % (instance, target_namespace)
     cluster_port = 3306
 
-    conn = await aiomysql.connect(
-        host=cluster_primary,
-        user=b64decode(cluster_secrets.data["rootUser"]).decode("ascii"),
-        password=b64decode(cluster_secrets.data["rootPassword"]).decode("ascii"),
-        port=cluster_port)
-    cur = await conn.cursor()
-
     # Drop database and user
-    user_name = database_name = ("%s_%s" % (namespace, name)).replace("-", "_")
-    await cur.execute("DROP DATABASE IF EXISTS `%s`" % database_name)
-    await cur.execute("DROP USER IF EXISTS %s" % repr(user_name))
-    await cur.execute("FLUSH PRIVILEGES")
+    user_name = database_name = qualified_name(namespace, name)
+    async with get_cluster_semaphore((target_namespace, instance), class_spec.get("maxConcurrency")), pools.acquire(
+            (target_namespace, instance),
+            host=cluster_primary,
+            user=cluster_secrets["rootUser"],
+            password=cluster_secrets["rootPassword"],
+            port=cluster_port) as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("DROP DATABASE IF EXISTS `%s`" % database_name)
+            await cur.execute("DROP USER IF EXISTS %s" % repr(user_name))
+            await cur.execute("FLUSH PRIVILEGES")
 
 
 @kopf.on.startup()
@@ -225,10 +309,23 @@ async def configure(settings: kopf.OperatorSettings, **_):
         await config.load_kube_config()
     else:
         config.load_incluster_config()
+    await open_api_client()
 
     settings.scanning.disabled = True
-    settings.posting.enabled = True
-    settings.persistence.finalizer = "mysql-operator"
+    # Events are posted by the aggregating event sink instead
+    settings.posting.enabled = False
+    open_event_sink("mysql-operator")
+    configure_webhook(settings, "mysql-database-operator")
+    settings.persistence.finalizer = FIELD_MANAGER
+    await open_shard_ring(settings, shards, creation)
+    spawn(Reclaimer("mysqldatabases", "clustermysqldatabaseclasses",
+        qualified_name, enumerate_catalog, drop_orphan, shards.owns).run())
     logging.info("mysql-operator starting up")
 
-asyncio.run(kopf.operator(clusterwide=True))
+
+@kopf.on.cleanup()
+async def cleanup(**_):
+    await shutdown()
+
+if __name__ == "__main__":
+    asyncio.run(kopf.operator(clusterwide=True))
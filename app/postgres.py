@@ -5,20 +5,114 @@ import kopf
 import logging
 import os
 import psycopg2
-from base64 import b64decode
-from kubernetes_asyncio.client.exceptions import ApiException
-from kubernetes_asyncio import client, config
-from lib import Secret, make_selector, make_resolver, parse_capacity
+from kubernetes_asyncio import config
+from lib import Coalescer, ConnectionPools, PhaseTimer, Reclaimer, ResourceGraph, Secret, configure_webhook, decode_secret, endpoints_ready, ensure_resource, fair, get_class_cache, get_cluster_semaphore, get_shard_ring, is_unchanged, make_fingerprint, make_resolver, make_selector, make_validator, open_api_client, open_event_sink, open_shard_ring, parse_capacity, read_credentials, shutdown, spawn, tear_down, wait_for_object
 
+FIELD_MANAGER = "postgres-operator"
+
+class_cache = get_class_cache("clusterpostgresdatabaseclasses")
 resolve_instance = make_resolver("clusterpostgresdatabaseclasses", "v1alpha1")
+shards = get_shard_ring("postgres-database-operator", "postgresdatabases")
+fingerprint = make_fingerprint(__file__)
+
+kopf.on.validate("postgresdatabases.codemowers.io", id="class", operations=["CREATE", "UPDATE"], ignore_failures=True)(
+    make_validator(class_cache))
+
+
+async def ping(conn):
+    async with conn.cursor() as cursor:
+        await cursor.execute("SELECT 1")
+
+
+pools = ConnectionPools(aiopg.create_pool, ping)
+
+
+async def provision(key, items):
+    """
+    Create databases and users for a batch of requests in one session,
+    passwords of existing users are reset to the published ones
+    """
+    async with get_cluster_semaphore(key, items[0]["limit"]), pools.acquire(key, **items[0]["connect"]) as conn:
+        async with conn.cursor() as cursor:
+            # CREATE DATABASE can't run in a transaction block, hence one by one
+            for item in items:
+                try:
+                    # TODO: why binding doesnt work here?!
+                    await cursor.execute("CREATE DATABASE \"%s\"" % item["database"])
+                except psycopg2.errors.DuplicateDatabase:
+                    pass
+
+            statements = []
+            for item in items:
+                statements.append("DO $$ BEGIN CREATE USER %s WITH ENCRYPTED PASSWORD %s; "
+                    "EXCEPTION WHEN duplicate_object THEN ALTER USER %s WITH ENCRYPTED PASSWORD %s; END $$;" % (
+                        item["user"], repr(item["password"]), item["user"], repr(item["password"])))
+                statements.append("GRANT ALL PRIVILEGES ON DATABASE \"%s\" TO \"%s\";" % (
+                    item["database"], item["user"]))
+            await cursor.execute("\n".join(statements))
+
+
+provisioner = Coalescer(provision)
+
+
+def qualified_name(namespace, name):
+    """
+    Database and user name for the PostgresDatabase
+    """
+    return ("%s_%s" % (namespace, name)).replace("-", "_")
+
+
+async def shared_cluster(class_spec):
+    """
+    Return pool key and connection parameters for the cluster shared
+    by objects of the class
+    """
+    target_namespace, instance = class_spec["targetNamespace"], class_spec["targetCluster"]
+    cluster_secrets = await read_credentials(
+        target_namespace, "postgres-%s-pguser-postgres" % instance, True)
+    return (target_namespace, instance), {
+        "database": "postgres",
+        "user": cluster_secrets["user"],
+        "password": cluster_secrets["password"],
+        "port": int(cluster_secrets["port"]),
+        "host": cluster_secrets["host"],
+    }
+
+
+async def enumerate_catalog(class_spec):
+    """
+    List databases having a user of the same name on the shared cluster
+    """
+    if "targetNamespace" not in class_spec or "targetCluster" not in class_spec:
+        return None
+    key, connect = await shared_cluster(class_spec)
+    async with pools.acquire(key, **connect) as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute("SELECT datname FROM pg_database WHERE datname IN (SELECT rolname FROM pg_roles)")
+            return [name for name, in await cursor.fetchall() if "_" in name]
 
 
-@kopf.on.resume("postgresdatabases.codemowers.io")
-@kopf.on.create("postgresdatabases.codemowers.io")
-async def creation(name, namespace, body, **kwargs):
-    target_namespace, instance, owner, api_client, api_instance, class_spec = await resolve_instance(
+async def drop_orphan(class_spec, name):
+    key, connect = await shared_cluster(class_spec)
+    async with get_cluster_semaphore(key, class_spec.get("maxConcurrency")), pools.acquire(key, **connect) as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute("DROP DATABASE IF EXISTS \"%s\"" % name)
+            await cursor.execute("DROP ROLE IF EXISTS \"%s\"" % name)
+
+
+@kopf.on.resume("postgresdatabases.codemowers.io", when=shards.owns)
+@kopf.on.create("postgresdatabases.codemowers.io", when=shards.owns)
+@fair
+async def creation(name, namespace, body, status, patch, **kwargs):
+    timer = PhaseTimer()
+    target_namespace, instance, owner, class_spec = await resolve_instance(
         namespace, name, body)
-    v1 = client.CoreV1Api(api_client)
+    timer.mark("ClassResolved")
+
+    digest = fingerprint(body["spec"], class_spec)
+    if await is_unchanged(status, digest, "/api/v1/namespaces/%s/secrets/postgres-database-%s-owner-secrets" % (namespace, name)):
+        logging.info("%s/%s unchanged since last run" % (namespace, name))
+        return
 
     capacity = body["spec"]["capacity"]
     replicas = class_spec["replicas"]
@@ -91,51 +185,35 @@ async def creation(name, namespace, body, **kwargs):
         }
 
         kopf.append_owner_reference(body, owner, block_owner_deletion=False)
-        try:
-            await api_instance.create_namespaced_custom_object(
-                "postgres-operator.crunchydata.com",
-                "v1beta1",
-                target_namespace,
-                "postgresclusters",
-                body)
-        except ApiException as e:
-            if e.status == 409:
-                logging.info("Postgres cluster %s/%s already generated" % (
-                    target_namespace, "postgres-%s" % instance))
-            else:
-                raise
-        else:
-            logging.info("Created Postgres cluster %s/%s" % (
-                target_namespace, "postgres-%s" % instance))
+        graph = ResourceGraph(FIELD_MANAGER)
+        graph.add("postgrescluster", body)
+        await graph.apply()
+        timer.mark("ClusterApplied")
+
+        # Continue as soon as the cluster is up instead of failing until retried
+        await wait_for_object(
+            "/api/v1/namespaces/%s/secrets" % target_namespace,
+            "postgres-%s-pguser-postgres" % instance)
+        await wait_for_object(
+            "/api/v1/namespaces/%s/endpoints" % target_namespace,
+            "postgres-%s-primary" % instance,
+            endpoints_ready)
+        timer.mark("ClusterReady")
 
     # Fetch secrets to create bucket
-    cluster_secrets = await v1.read_namespaced_secret(
+    cluster_secrets = await read_credentials(
+        target_namespace,
         "postgres-%s-pguser-postgres" % instance,
-        target_namespace)
-    cluster_port = int(b64decode(cluster_secrets.data["port"]).decode("ascii"))
-    cluster_hostname = b64decode(cluster_secrets.data["host"]).decode("ascii")
-
-    conn = await aiopg.connect(
-        database="postgres",
-        user=b64decode(cluster_secrets.data["user"]).decode("ascii"),
-        password=b64decode(cluster_secrets.data["password"]).decode("ascii"),
-        port=cluster_port,
-        host=cluster_hostname)
+        "targetCluster" in class_spec)
+    cluster_port = int(cluster_secrets["port"])
+    cluster_hostname = cluster_secrets["host"]
 
     # Create database
-    user_name = database_name = ("%s_%s" % (namespace, name)).replace("-", "_")
-
-    cursor = await conn.cursor()
-
-    try:
-        # TODO: why binding doesnt work here?!
-        await cursor.execute("CREATE DATABASE \"%s\"" % database_name)
-    except psycopg2.errors.DuplicateDatabase:
-        pass
+    user_name = database_name = qualified_name(namespace, name)
 
     # Create secret for accessing bucket
     database_secrets = Secret(namespace, "postgres-database-%s-owner-secrets" % name)
-    body = database_secrets.wrap([{
+    body = await database_secrets.wrap([{
         "key": "PGHOST",
         "value": cluster_hostname,
     }, {
@@ -155,25 +233,49 @@ async def creation(name, namespace, body, **kwargs):
         "value": "postgres://%s:%%(plaintext)s@%s:%d/%s" % (
             user_name, cluster_hostname, cluster_port, database_name)
     }])
-
-    await cursor.execute("CREATE USER %s WITH ENCRYPTED PASSWORD %s;" % (
-        user_name, repr(database_secrets["plaintext"])))
+    timer.mark("SecretGenerated")
 
     kopf.append_owner_reference(body, owner, block_owner_deletion=False)
-    try:
-        await v1.create_namespaced_secret(namespace, client.V1Secret(**body))
-    except ApiException as e:
-        if e.status == 409:
-            logging.info("Secret %s/%s already generated" % (namespace, database_secrets.name))
-        else:
-            raise
-    else:
-        logging.info("Created secret %s/%s" % (namespace, database_secrets.name))
 
-    await cursor.execute("GRANT ALL PRIVILEGES ON DATABASE \"%s\" TO \"%s\"" % (
-        database_name, user_name))
+    # Use the stored secret in case last run was interrupted
+    secrets = decode_secret((await ensure_resource(body))["data"])
+    timer.mark("CredentialsPublished")
+
+    await provisioner.submit((target_namespace, instance), {
+        "connect": {
+            "database": "postgres",
+            "user": cluster_secrets["user"],
+            "password": cluster_secrets["password"],
+            "port": cluster_port,
+            "host": cluster_hostname,
+        },
+        "database": database_name,
+        "user": user_name,
+        "password": secrets["PGPASSWORD"],
+        "limit": class_spec.get("maxConcurrency"),
+    })
+    timer.mark("DatabaseCreated")
+
+    patch.status["conditions"] = timer.conditions()
+    return {"state": "READY", "fingerprint": digest, "latency": round(timer.elapsed, 3)}
+
 
-    return {"state": "READY"}
+@kopf.on.delete("postgresdatabases.codemowers.io")
+async def deletion(name, namespace, body, **kwargs):
+    paths = ["/api/v1/namespaces/%s/secrets/postgres-database-%s-owner-secrets" % (namespace, name)]
+    if not await class_cache.get(body["spec"]["class"], missing_ok=True):
+        # Nothing else can be located without the class, objects owned
+        # by this one or the class are left to the garbage collector
+        await tear_down(paths)
+        return
+    target_namespace, instance, _, class_spec = await resolve_instance(
+        namespace, name, body)
+
+    # Databases on shared clusters are dropped by the reclaimer
+    if "targetCluster" not in class_spec and class_spec.get("storageClass"):
+        paths.append("/apis/postgres-operator.crunchydata.com/v1beta1/namespaces/%s/postgresclusters/postgres-%s" % (
+            target_namespace, instance))
+    await tear_down(paths, target_namespace == namespace)
 
 
 @kopf.on.startup()
@@ -182,10 +284,23 @@ async def configure(settings: kopf.OperatorSettings, **_):
         await config.load_kube_config()
     else:
         config.load_incluster_config()
+    await open_api_client()
 
     settings.scanning.disabled = True
-    settings.posting.enabled = True
-    settings.persistence.finalizer = "postgres-operator"
+    # Events are posted by the aggregating event sink instead
+    settings.posting.enabled = False
+    open_event_sink("postgres-operator")
+    configure_webhook(settings, "postgres-database-operator")
+    settings.persistence.finalizer = FIELD_MANAGER
+    await open_shard_ring(settings, shards, creation)
+    spawn(Reclaimer("postgresdatabases", "clusterpostgresdatabaseclasses",
+        qualified_name, enumerate_catalog, drop_orphan, shards.owns).run())
     logging.info("postgres-operator starting up")
 
-asyncio.run(kopf.operator(clusterwide=True))
+
+@kopf.on.cleanup()
+async def cleanup(**_):
+    await shutdown()
+
+if __name__ == "__main__":
+    asyncio.run(kopf.operator(clusterwide=True))
@@ -3,57 +3,42 @@ import asyncio
 import kopf
 import logging
 import os
-from base64 import b64decode
-from kubernetes_asyncio.client.exceptions import ApiException
-from kubernetes_asyncio import client, config, utils
-from lib import Secret, make_selector, parse_capacity
+from kubernetes_asyncio import config
+from lib import PhaseTimer, ResourceGraph, Secret, Sweeper, configure_webhook, create_resource, decode_secret, fair, get_class_cache, get_shard_ring, is_unchanged, make_fingerprint, make_selector, make_validator, open_api_client, open_event_sink, open_shard_ring, parse_capacity, read_credentials, roll_out, shutdown, spawn, tear_down, thaw
 
 REDIS_PORT = 6379
+FIELD_MANAGER = "redis-operator"
+
+class_cache = get_class_cache("clusterredisclasses")
+shards = get_shard_ring("redis-operator", "redises")
+fingerprint = make_fingerprint(__file__)
+
+
+def check_implementation(spec, class_spec):
+    """
+    Reject images and replica counts the operator does not know how to deploy
+    """
+    if not class_spec.get("podSpec"):
+        return
+    image = class_spec["podSpec"]["containers"][0]["image"]
+    if "keydb" in image.lower():
+        return
+    elif "redis" in image.lower():
+        if class_spec["replicas"] > 1:
+            raise kopf.PermanentError("Multiple replica deployment of vanilla Redis not supported")
+    else:
+        raise kopf.PermanentError("Don't know which implementation to use for image %s" % repr(image))
 
 
-@kopf.on.delete("redises.codemowers.io")
-async def deletion(name, namespace, body, **kwargs):
-    api_client = client.ApiClient()
-    apps_api = client.AppsV1Api()
-    api_instance = client.CustomObjectsApi(api_client)
-    v1 = client.CoreV1Api(api_client)
-    class_body = await api_instance.get_cluster_custom_object(
-        "codemowers.io",
-        "v1alpha1",
-        "clusterredisclasses",
-        body["spec"]["class"])
-    target_namespace = class_body["spec"].get("targetNamespace", namespace)
-    instance = name
-    if "targetNamespace" in class_body["spec"]:
-        instance = "%s-%s" % (namespace, instance)
-    service_name = "redis-cluster-%s" % instance
-    headless_name = "%s-headless" % service_name
-    await v1.delete_namespaced_service(service_name, target_namespace)
-    await v1.delete_namespaced_service(headless_name, target_namespace)
-    await apps_api.delete_namespaced_stateful_set(
-        "redis-cluster-%s" % instance,
-        target_namespace)
-    await v1.delete_namespaced_secret(
-        "redis-cluster-%s-secrets" % instance,
-        target_namespace)
-
-
-@kopf.on.resume("redises.codemowers.io")
-@kopf.on.create("redises.codemowers.io")
-async def creation(name, namespace, body, **kwargs):
-    print("Handling", namespace, name)
-    api_client = client.ApiClient()
-    api_instance = client.CustomObjectsApi(api_client)
-    v1 = client.CoreV1Api(api_client)
-
-    class_body = await api_instance.get_cluster_custom_object(
-        "codemowers.io",
-        "v1alpha1",
-        "clusterredisclasses",
-        body["spec"]["class"])
+kopf.on.validate("redises.codemowers.io", id="class", operations=["CREATE", "UPDATE"], ignore_failures=True)(
+    make_validator(class_cache, check_implementation))
 
-    # Handle target namespace/cluster mapping
-    target_namespace = class_body["spec"].get("targetNamespace", namespace)
+
+def locate(namespace, name, class_spec):
+    """
+    Derive target namespace and instance name of the Redis cluster
+    """
+    target_namespace = class_spec.get("targetNamespace", namespace)
     instance = name
 
     # TODO: Make sure origin namespace/name do not contain dashes,
@@ -61,8 +46,64 @@ async def creation(name, namespace, body, **kwargs):
 
     # Prefix instance name with origin namespace if
     # we're hoarding instances into single namespace
-    if "targetNamespace" in class_body["spec"]:
+    if "targetNamespace" in class_spec:
         instance = "%s-%s" % (namespace, instance)
+    return target_namespace, instance
+
+
+async def expected_objects(namespace, name, body):
+    """
+    Objects created for a Redis, the sweeper recreates missing ones
+    except for the cluster secret holding the password in use
+    """
+    class_body = await class_cache.get(body["spec"]["class"])
+    if not class_body["spec"].get("podSpec"):
+        return {}
+    target_namespace, instance = locate(namespace, name, class_body["spec"])
+    service_name = "redis-cluster-%s" % instance
+    return {
+        ("statefulsets", target_namespace, service_name): {"spec": {"replicas": class_body["spec"]["replicas"]}},
+        ("services", target_namespace, service_name): None,
+        ("services", target_namespace, "%s-headless" % service_name): None,
+        ("secrets", target_namespace, "redis-cluster-%s-secrets" % instance): Sweeper.GENERATED,
+        ("secrets", namespace, "redis-%s-owner-secrets" % name): None,
+    }
+
+
+@kopf.on.delete("redises.codemowers.io")
+async def deletion(name, namespace, body, **kwargs):
+    class_body = await class_cache.get(body["spec"]["class"], missing_ok=True)
+    if not class_body:
+        # Nothing else can be located without the class, objects owned
+        # by this one or the class are left to the garbage collector
+        await tear_down(["/api/v1/namespaces/%s/secrets/redis-%s-owner-secrets" % (namespace, name)])
+        return
+    target_namespace, instance = locate(namespace, name, class_body["spec"])
+    service_name = "redis-cluster-%s" % instance
+    headless_name = "%s-headless" % service_name
+    await tear_down([
+        "/api/v1/namespaces/%s/services/%s" % (target_namespace, service_name),
+        "/api/v1/namespaces/%s/services/%s" % (target_namespace, headless_name),
+        "/apis/apps/v1/namespaces/%s/statefulsets/redis-cluster-%s" % (target_namespace, instance),
+        "/api/v1/namespaces/%s/secrets/redis-cluster-%s-secrets" % (target_namespace, instance),
+    ], target_namespace == namespace)
+
+
+@kopf.on.resume("redises.codemowers.io", when=shards.owns)
+@kopf.on.create("redises.codemowers.io", when=shards.owns)
+@fair
+async def creation(name, namespace, body, status, patch, **kwargs):
+    timer = PhaseTimer()
+    class_body = await class_cache.get(body["spec"]["class"])
+    timer.mark("ClassResolved")
+
+    digest = fingerprint(body["spec"], class_body["spec"])
+    if await is_unchanged(status, digest, "/api/v1/namespaces/%s/secrets/redis-%s-owner-secrets" % (namespace, name)):
+        logging.info("%s/%s unchanged since last run" % (namespace, name))
+        return
+
+    # Handle target namespace/cluster mapping
+    target_namespace, instance = locate(namespace, name, class_body["spec"])
 
     # Service hostname and FQDN
     service_name = "redis-cluster-%s" % instance
@@ -77,11 +118,14 @@ async def creation(name, namespace, body, **kwargs):
 
     labels, label_selector = make_selector("redis", instance)
 
-    pod_spec = class_body["spec"].get("podSpec", {})
+    pod_spec = thaw(class_body["spec"].get("podSpec", {}))
     storage_class = class_body["spec"].get("storageClass", None)
 
     sec = Secret(target_namespace, "redis-cluster-%s-secrets" % instance)
 
+    # Fail permanently for objects admitted before the class was changed
+    check_implementation(body["spec"], class_body["spec"])
+
     if pod_spec:
         # AZ handling
         pod_spec["affinity"] = {
@@ -100,25 +144,16 @@ async def creation(name, namespace, body, **kwargs):
             }
         }]
 
-        # Create cluster secrets
-        body = sec.wrap([{
+        # Cluster secrets
+        secret_body = await sec.wrap([{
             "key": "REDIS_PASSWORD",
             "value": "%(plaintext)s"
         }, {
             "key": "redis.conf",
             "value": "masterauth \"%(plaintext)s\"\nrequirepass \"%(plaintext)s\"\n",
-        }])
-
-        kopf.append_owner_reference(body, owner, block_owner_deletion=False)
-        try:
-            await v1.create_namespaced_secret(target_namespace, client.V1Secret(**body))
-        except ApiException as e:
-            if e.status == 409:
-                logging.info("Secret %s/%s already generated" % (target_namespace, sec.name))
-            else:
-                raise
-        else:
-            logging.info("Created secret %s/%s" % (target_namespace, sec.name))
+        }], labels)
+
+        kopf.append_owner_reference(secret_body, owner, block_owner_deletion=False)
 
         # Assume it's the first container in the pod
         container_spec = pod_spec["containers"][0]
@@ -138,11 +173,6 @@ async def creation(name, namespace, body, **kwargs):
                 ]
             # KeyDB does not support multiple "databases"
             extra_secret_mappings = []
-        elif "redis" in container_spec["image"].lower():
-            if replicas > 1:
-                raise NotImplementedError("Multiple replica deployment of vanilla Redis not supported")
-        else:
-            raise NotImplementedError("Don't know which implementation to use for image %s" % repr(container_spec["image"]))
 
         if not storage_class:
             args += [
@@ -150,7 +180,7 @@ async def creation(name, namespace, body, **kwargs):
                 ""
             ]
 
-        # Create stateful set
+        # Stateful set
         container_spec["args"] = container_spec.get("args", []) + args
         container_spec["env"] = [{
             "name": "SERVICE_NAME",
@@ -211,21 +241,15 @@ async def creation(name, namespace, body, **kwargs):
             }]
 
         kopf.append_owner_reference(statefulset_body, owner, block_owner_deletion=False)
-        try:
-            await utils.create_from_yaml_single_item(api_client, statefulset_body)
-        except ApiException as e:
-            if e.status == 409:
-                logging.info("Secret %(namespace)s/%(name)s already generated" % statefulset_body["metadata"])
-            else:
-                raise
-
-        # Create service
-        body = {
+
+        # Service
+        service_body = {
             "kind": "Service",
             "apiVersion": "v1",
             "metadata": {
                 "namespace": target_namespace,
                 "name": service_name,
+                "labels": labels,
             },
             "spec": {
                 "selector": labels,
@@ -238,22 +262,16 @@ async def creation(name, namespace, body, **kwargs):
             }
 
         }
-        kopf.append_owner_reference(body, owner, block_owner_deletion=False)
-        try:
-            await utils.create_from_yaml_single_item(api_client, body)
-        except ApiException as e:
-            if e.status == 409:
-                logging.info("Service %(namespace)s/%(name)s already generated" % body["metadata"])
-            else:
-                raise
-
-        # Create headless service
-        body = {
+        kopf.append_owner_reference(service_body, owner, block_owner_deletion=False)
+
+        # Headless service
+        headless_body = {
             "kind": "Service",
             "apiVersion": "v1",
             "metadata": {
                 "namespace": target_namespace,
                 "name": headless_name,
+                "labels": labels,
             },
             "spec": {
                 "selector": labels,
@@ -266,23 +284,29 @@ async def creation(name, namespace, body, **kwargs):
             }
         }
 
-        kopf.append_owner_reference(body, owner, block_owner_deletion=False)
-        try:
-            await utils.create_from_yaml_single_item(api_client, body)
-        except ApiException as e:
-            if e.status == 409:
-                logging.info("Headless service %(namespace)s/%(name)s already generated" % body["metadata"])
-            else:
-                raise
+        kopf.append_owner_reference(headless_body, owner, block_owner_deletion=False)
+
+        # Create cluster secret before the stateful set referring to it,
+        # services can be created concurrently
+        graph = ResourceGraph(FIELD_MANAGER)
+        graph.add("secret", secret_body, generated=True)
+        graph.add("statefulset", statefulset_body, depends=("secret",))
+        graph.add("service", service_body)
+        graph.add("headless", headless_body)
+        await graph.apply()
+        timer.mark("ClusterApplied")
 
         # Create database secrets
-        cluster_secrets = await v1.read_namespaced_secret(sec.name, target_namespace)
+        if graph.results["secret"]:
+            cluster_secrets = decode_secret(graph.results["secret"]["data"])
+        else:
+            cluster_secrets = await read_credentials(target_namespace, sec.name, False)
         database_secrets = Secret(
             namespace,
             "redis-%s-owner-secrets" % name,
-            b64decode(cluster_secrets.data["REDIS_PASSWORD"]).decode("ascii")
+            cluster_secrets["REDIS_PASSWORD"]
         )
-        body = database_secrets.wrap([{
+        owner_secret = await database_secrets.wrap([{
             "key": "REDIS_PASSWORD",
             "value": "%(plaintext)s"
         }, {
@@ -300,18 +324,25 @@ async def creation(name, namespace, body, **kwargs):
         }] + [{
             "key": "REDIS_%d_URI" % j,
             "value": "redis://:%%(plaintext)s@%s/%d" % (service_fqdn, j),
-        } for j in range(0, 16)])
-        kopf.append_owner_reference(body, block_owner_deletion=False)
-        try:
-            await v1.create_namespaced_secret(namespace, client.V1Secret(**body))
-        except ApiException as e:
-            if e.status == 409:
-                logging.info("Secret %s/%s already generated" % (namespace, database_secrets.name))
-            else:
-                raise
-        else:
-            logging.info("Created secret %s/%s" % (namespace, database_secrets.name))
-    return {"state": "READY"}
+        } for j in range(0, 16)], labels)
+        timer.mark("SecretGenerated")
+        kopf.append_owner_reference(owner_secret, body, block_owner_deletion=False)
+        await create_resource(owner_secret)
+        timer.mark("CredentialsPublished")
+    patch.status["conditions"] = timer.conditions()
+    return {"state": "READY", "fingerprint": digest, "latency": round(timer.elapsed, 3)}
+
+
+@kopf.index("redises.codemowers.io")
+async def redises_by_class(namespace, name, spec, **_):
+    return {spec["class"]: (namespace, name)}
+
+
+@kopf.on.update("clusterredisclasses.codemowers.io", field="spec")
+async def class_update(name, body, redises_by_class, **_):
+    # Reconcile only objects of this replica referring to the class with the new spec
+    class_cache.put(body)
+    await roll_out([key for key in redises_by_class.get(name, ()) if shards.owns(*key)], "redises", creation)
 
 
 @kopf.on.startup()
@@ -320,10 +351,22 @@ async def configure(settings: kopf.OperatorSettings, **_):
         await config.load_kube_config()
     else:
         config.load_incluster_config()
+    await open_api_client()
 
     settings.scanning.disabled = True
-    settings.posting.enabled = True
-    settings.persistence.finalizer = "redis-operator"
+    # Events are posted by the aggregating event sink instead
+    settings.posting.enabled = False
+    open_event_sink("redis-operator")
+    configure_webhook(settings, "redis-operator")
+    settings.persistence.finalizer = FIELD_MANAGER
+    await open_shard_ring(settings, shards, creation)
+    spawn(Sweeper("redises", creation, expected_objects, {"app.kubernetes.io/name": "redis"}, shards.owns).run())
     logging.info("redis-operator starting up")
 
-asyncio.run(kopf.operator(clusterwide=True))
+
+@kopf.on.cleanup()
+async def cleanup(**_):
+    await shutdown()
+
+if __name__ == "__main__":
+    asyncio.run(kopf.operator(clusterwide=True))
@@ -3,31 +3,40 @@ import asyncio
 import kopf
 import logging
 import os
-from kubernetes_asyncio.client.exceptions import ApiException
-from kubernetes_asyncio import client, config
-from lib import Secret
+from kubernetes_asyncio import config
+from lib import PhaseTimer, Secret, Sweeper, create_resource, fair, get_shard_ring, is_unchanged, make_fingerprint, make_selector, open_api_client, open_event_sink, open_shard_ring, shutdown, spawn
 
+fingerprint = make_fingerprint(__file__)
+shards = get_shard_ring("secret-operator", "secrets")
 
-@kopf.on.resume("secrets.codemowers.io")
-@kopf.on.create("secrets.codemowers.io")
-async def creation(name, namespace, body, **kwargs):
-    api_client = client.ApiClient()
-    v1 = client.CoreV1Api(api_client)
+
+async def expected_objects(namespace, name, body):
+    """
+    The generated secret, the sweeper recreates it if missing
+    """
+    return {("secrets", namespace, name): None}
+
+
+@kopf.on.resume("secrets.codemowers.io", when=shards.owns)
+@kopf.on.create("secrets.codemowers.io", when=shards.owns)
+@fair
+async def creation(name, namespace, body, status, patch, **kwargs):
+    timer = PhaseTimer()
+    digest = fingerprint(body["spec"])
+    if await is_unchanged(status, digest, "/api/v1/namespaces/%s/secrets/%s" % (namespace, name)):
+        logging.info("%s/%s unchanged since last run" % (namespace, name))
+        return
 
     # Construct secret for cluster secrets
+    labels, _ = make_selector("secret", name)
     sec = Secret(namespace, name)
-    body = sec.wrap(body["spec"]["mapping"])
-    kopf.append_owner_reference(body)
-    try:
-        await v1.create_namespaced_secret(namespace, client.V1Secret(**body))
-    except ApiException as e:
-        if e.status == 409:
-            logging.info("Secret %s/%s already generated" % (namespace, sec.name))
-        else:
-            raise
-    else:
-        logging.info("Created secret %s/%s" % (namespace, sec.name))
-    return {"state": "READY"}
+    secret_body = await sec.wrap(body["spec"]["mapping"], labels)
+    timer.mark("SecretGenerated")
+    kopf.append_owner_reference(secret_body, body)
+    await create_resource(secret_body)
+    timer.mark("CredentialsPublished")
+    patch.status["conditions"] = timer.conditions()
+    return {"state": "READY", "fingerprint": digest, "latency": round(timer.elapsed, 3)}
 
 
 @kopf.on.startup()
@@ -36,10 +45,21 @@ async def configure(settings: kopf.OperatorSettings, **_):
         await config.load_kube_config()
     else:
         config.load_incluster_config()
+    await open_api_client()
     settings.scanning.disabled = True
-    settings.posting.enabled = True
+    # Events are posted by the aggregating event sink instead
+    settings.posting.enabled = False
+    open_event_sink("secret-operator")
     settings.persistence.finalizer = "secret-operator"
+    await open_shard_ring(settings, shards, creation)
+    spawn(Sweeper("secrets", creation, expected_objects, {"app.kubernetes.io/name": "secret"}, shards.owns).run())
     logging.info("secret-operator starting up")
 
 
-asyncio.run(kopf.operator(clusterwide=True))
+@kopf.on.cleanup()
+async def cleanup(**_):
+    await shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(kopf.operator(clusterwide=True))
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Measure start-up time and resident memory of every operator run in a process
+of its own against the single-process bundle running all of them,
+run from repository root: python3 benchmarks/bundle.py
+Each configuration is started in a fresh interpreter and measured until the
+operator modules are imported and their handlers registered, connections
+and caches built up once the operators are running are not included
+"""
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+ROUNDS = int(os.getenv("ROUNDS", "5"))
+
+
+def child(names):
+    import bundle
+    for name in names:
+        bundle.load(name)
+    # Maximum resident set size is reported in kilobytes on Linux
+    print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+def measure(names):
+    durations, sizes = [], []
+    for _ in range(ROUNDS):
+        started = time.monotonic()
+        output = subprocess.check_output([sys.executable, __file__] + list(names))
+        durations.append(time.monotonic() - started)
+        sizes.append(int(output) / 1024)
+    return statistics.median(durations), statistics.median(sizes)
+
+
+def main():
+    import bundle
+    total_duration, total_size = 0, 0
+    for name in bundle.OPERATORS:
+        duration, size = measure([name])
+        total_duration += duration
+        total_size += size
+        print("%-12s %6.2fs start-up, %6.1f MiB RSS" % (name, duration, size))
+    print("%-12s %6.2fs start-up, %6.1f MiB RSS" % ("separate", total_duration, total_size))
+    duration, size = measure(bundle.OPERATORS)
+    print("%-12s %6.2fs start-up, %6.1f MiB RSS" % ("bundle", duration, size))
+
+
+if __name__ == "__main__":
+    if sys.argv[1:]:
+        child(sys.argv[1:])
+    else:
+        main()
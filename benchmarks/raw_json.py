@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Compare per-call CPU cost of the OpenAPI model path of kubernetes_asyncio
+against the raw JSON path of lib.api_request for a typical generated secret,
+run from repository root: python3 benchmarks/raw_json.py
+"""
+import asyncio
+import json
+import os
+import sys
+import timeit
+from base64 import b64encode
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+from kubernetes_asyncio import client  # noqa: E402
+from lib import json_dumps, json_loads, orjson  # noqa: E402
+
+ROUNDS = int(os.getenv("ROUNDS", "2000"))
+
+BODY = {
+    "apiVersion": "v1",
+    "kind": "Secret",
+    "metadata": {
+        "name": "redis-cluster-foo-secrets",
+        "namespace": "foo",
+        "ownerReferences": [{
+            "apiVersion": "codemowers.io/v1alpha1",
+            "kind": "Redis",
+            "name": "foo",
+            "uid": "6e1f2a36-9a57-4ad8-a3a1-3f3c2a1c1b1e",
+            "controller": True,
+            "blockOwnerDeletion": False,
+        }],
+    },
+    "data": dict(("REDIS_%d_URI" % j, b64encode(
+        b"redis://:secret@redis-cluster-foo.foo.svc.cluster.local/%d" % j).decode("ascii")) for j in range(16)),
+}
+
+RESPONSE = json_dumps({
+    **BODY,
+    "metadata": {
+        **BODY["metadata"],
+        "uid": "0b0c5d7e-8f5e-4f59-9d4a-2c3a4b5c6d7e",
+        "resourceVersion": "123456",
+        "creationTimestamp": "2023-01-01T00:00:00Z",
+        "managedFields": [{
+            "manager": "redis-operator",
+            "operation": "Update",
+            "apiVersion": "v1",
+            "time": "2023-01-01T00:00:00Z",
+            "fieldsType": "FieldsV1",
+            "fieldsV1": {"f:data": dict(("f:%s" % key, {}) for key in BODY["data"])},
+        }],
+    },
+    "type": "Opaque",
+})
+
+
+async def main():
+    api_client = client.ApiClient(client.Configuration())
+
+    def model():
+        # Same steps as create_namespaced_secret and read_namespaced_secret
+        body = api_client.sanitize_for_serialization(client.V1Secret(
+            api_version=BODY["apiVersion"],
+            kind=BODY["kind"],
+            metadata=client.V1ObjectMeta(
+                name=BODY["metadata"]["name"],
+                namespace=BODY["metadata"]["namespace"],
+                owner_references=[client.V1OwnerReference(
+                    api_version=ref["apiVersion"],
+                    kind=ref["kind"],
+                    name=ref["name"],
+                    uid=ref["uid"],
+                    controller=ref["controller"],
+                    block_owner_deletion=ref["blockOwnerDeletion"],
+                ) for ref in BODY["metadata"]["ownerReferences"]]),
+            data=BODY["data"]))
+        json.dumps(body)
+        secret = api_client.deserialize(SimpleNamespace(data=RESPONSE), "V1Secret")
+        return secret.data["REDIS_0_URI"]
+
+    def raw():
+        json_dumps(BODY)
+        secret = json_loads(RESPONSE)
+        return secret["data"]["REDIS_0_URI"]
+
+    assert model() == raw()
+    print("JSON library: %s" % ("orjson" if orjson else "json"))
+    for label, fn in (("model", model), ("raw", raw)):
+        elapsed = min(timeit.repeat(fn, number=ROUNDS, repeat=5))
+        print("%-6s %8.1f us per call" % (label, elapsed / ROUNDS * 1e6))
+    await api_client.close()
+
+
+asyncio.run(main())
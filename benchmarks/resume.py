@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Measure restart-to-steady-state time of the resume handler of the secret
+operator against an in-process fake API server, comparing the full creation
+path with the fingerprint check, run from repository root:
+python3 benchmarks/resume.py
+The fake API server runs in the same process and its CPU time is included
+"""
+import asyncio
+import os
+import sys
+import time
+from aiohttp import web
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+# Keep hashing cheap so that 10k objects finish in reasonable time,
+# with production cost factors the full path is far slower still
+os.environ.setdefault("BCRYPT_ROUNDS", "4")
+
+# Measure handler cost rather than client-side rate limits
+for variable in ("KUBE_READ_QPS", "KUBE_WRITE_QPS", "KUBE_READ_BURST", "KUBE_WRITE_BURST"):
+    os.environ.setdefault(variable, "1000000")
+
+import kopf  # noqa: E402
+from kubernetes_asyncio import client  # noqa: E402
+import lib  # noqa: E402
+import secret  # noqa: E402
+
+OBJECTS = int(os.getenv("OBJECTS", "10000"))
+CONCURRENCY = int(os.getenv("CONCURRENCY", "32"))
+PORT = int(os.getenv("PORT", "18080"))
+
+MAPPING = [{
+    "key": "PASSWORD",
+    "value": "%(plaintext)s",
+}, {
+    "key": "PASSWORD_SHA256",
+    "value": "%(sha256)s",
+}, {
+    "key": "PASSWORD_BCRYPT",
+    "value": "%(bcrypt)s",
+}, {
+    "key": "URI",
+    "value": "redis://:%(plaintext)s@redis.example.svc.cluster.local",
+}]
+
+async def handle_get(request):
+    return web.json_response({
+        "apiVersion": "v1",
+        "kind": "Secret",
+        "metadata": {"name": request.match_info["name"], "namespace": request.match_info["namespace"]},
+    })
+
+
+async def handle_post(request):
+    await request.read()
+    return web.json_response({"kind": "Status", "code": 409}, status=409)
+
+
+async def resume(objects):
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+
+    async def run(body):
+        async with semaphore:
+            result = await secret.creation(
+                name=body["metadata"]["name"],
+                namespace=body["metadata"]["namespace"],
+                body=body,
+                status=body["status"],
+                patch=kopf.Patch())
+            if result:
+                body["status"]["creation"] = result
+
+    started, cpu = time.monotonic(), time.process_time()
+    await asyncio.gather(*[run(body) for body in objects])
+    return time.monotonic() - started, time.process_time() - cpu
+
+
+async def main():
+    app = web.Application()
+    app.router.add_get("/api/v1/namespaces/{namespace}/secrets/{name}", handle_get)
+    app.router.add_post("/api/v1/namespaces/{namespace}/secrets", handle_post)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", PORT).start()
+
+    configuration = client.Configuration()
+    configuration.host = "http://127.0.0.1:%d" % PORT
+    client.Configuration.set_default(configuration)
+    await lib.open_api_client()
+
+    objects = [{
+        "apiVersion": "codemowers.io/v1alpha1",
+        "kind": "Secret",
+        "metadata": {"name": "secret-%d" % j, "namespace": "ns-%d" % (j % 100), "uid": "uid-%d" % j},
+        "spec": {"mapping": MAPPING},
+        "status": {},
+    } for j in range(OBJECTS)]
+
+    # First run has no fingerprints stored, second run is a restart
+    for label in ("full", "fingerprint"):
+        elapsed, cpu = await resume(objects)
+        print("%-12s %d objects in %6.2fs, %6.1f us CPU per object" % (
+            label, OBJECTS, elapsed, cpu / OBJECTS * 1e6))
+
+    await lib.shutdown()
+    await runner.cleanup()
+
+
+asyncio.run(main())
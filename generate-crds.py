@@ -12,6 +12,7 @@ PROPS_COMMON = (
 
 PROPS_SHAREABLE = (
   ("targetCluster", {"type": "string"}), # Do not set to create dedicated cluster for this bucket
+  ("maxConcurrency", {"type": "integer", "minimum": 1}), # Simultaneous provisioning operations per cluster
 )
 
 PROPS_PERSISTENT = (
@@ -100,6 +101,10 @@ BASE_PRINTER_COLUMNS = [{
     "jsonPath": ".status.creation.state",
     "name": "Ready",
     "type": "string",
+}, {
+    "jsonPath": ".status.creation.latency",
+    "name": "Latency",
+    "type": "number",
 }]
 
 RESOURCE_VERSIONS = [{
@@ -122,10 +127,9 @@ RESOURCE_VERSIONS = [{
             "type": "object",
             "required": ["spec"],
             "properties": {
-                "status": {
-                    "type": "object",
+                "status": dict(STATUS_SUBRESOURCE, **{
                     "x-kubernetes-preserve-unknown-fields": True
-                },
+                }),
                 "spec": {
                     "type": "object",
                     "required": ["capacity", "class"],